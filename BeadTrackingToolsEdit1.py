@@ -10,10 +10,12 @@ Author: Donald Woodbry, University of Toronto
 '''
 
 from tkinter import *
-from PIL import Image, ImageSequence, ImageDraw, ImageTk
+from PIL import Image, ImageSequence, ImageDraw, ImageTk, TiffImagePlugin
 from numpy import average
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pylab
-import os, shutil
+import os, shutil, threading
 
 class Image_clicker(object):
     def __init__(self, image, parent = None):
@@ -42,14 +44,150 @@ class Image_clicker(object):
         self.click = (event.x, event.y)
         self.root.quit()
 
+class FrameCache(object):
+    '''renders the frames of the image sequence im (or the TIFF file of that
+        name) on demand, marked where the object was tracked in track (the
+        positions in the frames from start_frame on) and downscaled by
+        scale, for Display_Results to show without saving them first.
+
+        Rendered frames are kept in a least recently used cache of at most
+        max_bytes, and a background thread renders up to prefetch frames
+        on either side of the last one asked for, so that moving the slider
+        to a nearby frame needs no decoding.'''
+
+    def __init__(self, im, track, start_frame, dot_size = 2, scale = 1.0, \
+                 max_bytes = 256 * 2**20, prefetch = 8):
+        if isinstance(im, str):
+            im = Image.open(im)
+        self.im = im
+        self.track = track
+        # track starts at the first frame of the sequence read
+        self.start_frame = max(start_frame, 0)
+        self.dot_size = dot_size
+        self.scale = scale
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.frame_bytes = None
+        self.target = None
+        self.closed = False
+        # lock guards the cache, im_lock the image sequence, which cannot
+        # be read by two threads at once
+        self.lock = threading.Lock()
+        self.im_lock = threading.Lock()
+        self.wanted = threading.Condition(self.lock)
+        self.thread = threading.Thread(target = self.prefetcher)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def render(self, j):
+        '''returns frame j marked and scaled, or None if it does not exist'''
+        with self.im_lock:
+            try:
+                self.im.seek(j)
+            except EOFError:
+                return None
+            frame = self.im.convert('RGB')
+        return annotate_frame(frame, self.track[j - self.start_frame], \
+                              self.dot_size, self.scale)
+
+    def store(self, j, frame):
+        with self.lock:
+            if j in self.frames:
+                return
+            w, h = frame.size
+            self.frame_bytes = 3*w*h
+            self.frames[j] = frame
+            self.nbytes += self.frame_bytes
+            while self.nbytes > self.max_bytes and len(self.frames) > 1:
+                self.frames.popitem(last = False)
+                self.nbytes -= self.frame_bytes
+            # the prefetcher waits for the size of the first frame
+            self.wanted.notify()
+
+    def get(self, j):
+        '''returns frame j, rendering it now if it is not cached'''
+        j = min(max(int(j), self.start_frame), self.last_frame())
+        with self.lock:
+            frame = self.frames.get(j)
+            if frame is not None:
+                self.frames.move_to_end(j)
+            self.target = j
+            self.wanted.notify()
+        if frame is None:
+            frame = self.render(j)
+            if frame is not None:
+                self.store(j, frame)
+        return frame
+
+    def last_frame(self):
+        return self.start_frame + len(self.track) - 1
+
+    def next_missing(self):
+        '''returns the frame nearest the target that should be prefetched,
+            or None if they are all cached. Called with lock held.'''
+        if self.target is None or self.frame_bytes is None:
+            return None
+        # prefetch no more than half the cache holds on both sides
+        # together, so that prefetched frames evict neither each other nor
+        # the target
+        n = min(self.prefetch, self.max_bytes // self.frame_bytes // 4)
+        for d in range(1, n + 1):
+            for j in (self.target + d, self.target - d):
+                if self.start_frame <= j <= self.last_frame() and \
+                   j not in self.frames:
+                    return j
+        return None
+
+    def prefetcher(self):
+        while True:
+            with self.lock:
+                j = self.next_missing()
+                while j is None and not self.closed:
+                    self.wanted.wait()
+                    j = self.next_missing()
+                if self.closed:
+                    return
+            frame = self.render(j)
+            if frame is None:
+                with self.lock:
+                    # past the end of the sequence
+                    self.target = None
+            else:
+                self.store(j, frame)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wanted.notify()
+        self.thread.join()
+
 class Display_Results(object):
+    '''displays the marked frames saved by save_frame or export_frames in
+        im_dir, which is either a directory of JPEGs or a multi-page TIFF,
+        with a slider to choose the frame. If only every stride-th frame was
+        exported, the nearest earlier exported frame is shown. im_dir may
+        also be a FrameCache, which renders the frames as they are shown
+        from the video itself; nothing is then deleted on closing.'''
+
     def __init__(self, im_dir, plot_title, start_frame, end_frame, \
-                 save_frames = False, parent = None):
+                 save_frames = False, parent = None, stride = 1):
 
         self.im_dir = im_dir
+        self.start_frame = start_frame
+        self.stride = stride
+        self.stack = None
+        self.cache = None
+        if isinstance(im_dir, FrameCache):
+            self.cache = im_dir
+            save_frames = True
+        elif os.path.isfile(im_dir):
+            self.stack = Image.open(im_dir)
         self.root = Toplevel(master=parent)
 
-        track_image = Image.open(os.path.join(self.im_dir, 'Frame%d.jpg' % (start_frame+1)))
+        track_image = self.load_image(start_frame)
         self.tk_track = ImageTk.PhotoImage(track_image)
         xsize, ysize = track_image.size
         
@@ -72,17 +210,48 @@ class Display_Results(object):
             self.root.protocol("WM_DELETE_WINDOW", self.end_disp)
         self.root.mainloop()
 
+    def load_image(self, frame_num):
+        if self.cache is not None:
+            return self.cache.get(frame_num)
+        k = (int(frame_num) - self.start_frame) // self.stride
+        if self.stack is not None:
+            self.stack.seek(min(k, getattr(self.stack, 'n_frames', 1) - 1))
+            return self.stack
+        j = self.start_frame + k*self.stride
+        return Image.open(os.path.join(self.im_dir, 'Frame%d.jpg' % (j+1)))
+
     def update_image(self, frame_num):
-        track_image = Image.open(os.path.join(self.im_dir, 'Frame%d.jpg' % (int(frame_num)+1)))
+        track_image = self.load_image(frame_num)
         self.tk_track.paste(track_image)
         
     def del_dir(self):
-        shutil.rmtree(self.im_dir)
+        if self.stack is not None:
+            self.stack.close()
+            os.remove(self.im_dir)
+        else:
+            shutil.rmtree(self.im_dir)
         self.root.quit()
 
     def end_disp(self):
+        if self.cache is not None:
+            self.cache.close()
         self.root.quit()
 
+def frame_range(im, start_frame, stop_frame):
+    '''yields (i, frame) for the frames start_frame to stop_frame (inclusive)
+        of the image sequence im. The sequence is seeked directly to
+        start_frame and reading stops once stop_frame has been read or the
+        sequence ends, so only the requested range is decoded.'''
+
+    i = max(start_frame, 0)
+    while i <= stop_frame:
+        try:
+            im.seek(i)
+        except EOFError:
+            return
+        yield i, im
+        i += 1
+
 def save_frame(im, directory, track, start_frame, end_frame, dot_size):
     '''creates a new folder under the directory and then
         saves and numbers the frames from im within it,
@@ -104,23 +273,89 @@ def save_frame(im, directory, track, start_frame, end_frame, dot_size):
     # iterating over all frames in the sequence and drawing a dot
     # where the program has determined the particle is
 
-    j = 0    
-    for frame in ImageSequence.Iterator(im):
+    for j, frame in frame_range(im, start_frame, end_frame):
         frame = frame.convert('RGB')
-        if start_frame -1 < j < end_frame+1:
-            frame_num = j-start_frame
-
-            d = dot_size/2
-            x, y = track[frame_num]
-            draw = ImageDraw.Draw(frame)
-            draw.rectangle((x-d, y-d, x+d, y+d), fill = 'Blue')
-            #saving the image in the directory under the name 'Framej.jpg'                  
-            frame.save(os.path.join(directory1, 'Frame%d.jpg' % (j+1)))
+        frame_num = j-start_frame
 
-        j += 1
+        d = dot_size/2
+        x, y = track[frame_num]
+        draw = ImageDraw.Draw(frame)
+        draw.rectangle((x-d, y-d, x+d, y+d), fill = 'Blue')
+        #saving the image in the directory under the name 'Framej.jpg'                  
+        frame.save(os.path.join(directory1, 'Frame%d.jpg' % (j+1)))
 
     return directory1
 
+def annotate_frame(frame, position, dot_size, scale = 1.0):
+    '''returns the RGB image frame downscaled by scale with a dot of
+        dot_size pixels marking position (in the pixels of the full frame)'''
+
+    if scale != 1.0:
+        w, h = frame.size
+        frame = frame.resize((max(int(w*scale), 1), max(int(h*scale), 1)), \
+                             Image.BILINEAR)
+    # the dot keeps its size, so it stays visible in a reduced frame
+    d = dot_size/2
+    x, y = position[0]*scale, position[1]*scale
+    draw = ImageDraw.Draw(frame)
+    draw.rectangle((x-d, y-d, x+d, y+d), fill = 'Blue')
+    return frame
+
+def export_frames(im, path, track, start_frame, end_frame, dot_size, \
+                  stride = 1, scale = 1.0, workers = None):
+    '''writes every stride-th frame from start_frame to end_frame of im,
+        downscaled by scale and marked where the object was tracked, to
+        path. If path ends in .tif or .tiff the frames are the pages of a
+        single multi-page TIFF, otherwise they are saved as
+        path/Framej.jpg as by save_frame. Returns path.
+
+        Frames are read in order, then marked, scaled and (for JPEGs)
+        encoded by a pool of worker threads, one per core by default. At
+        most two frames per worker are in flight, so memory use does not
+        grow with the length of the video.'''
+
+    tiff = os.path.splitext(path)[1].lower() in ('.tif', '.tiff')
+    if not tiff and not os.path.isdir(path):
+        os.makedirs(path)
+    # the track may have ended early, once the stiffness converged
+    end_frame = min(end_frame, start_frame + len(track) - 1)
+    workers = workers or os.cpu_count() or 1
+
+    def render(j, frame):
+        frame = annotate_frame(frame, track[j-start_frame], dot_size, scale)
+        if not tiff:
+            frame.save(os.path.join(path, 'Frame%d.jpg' % (j+1)))
+        return frame
+
+    def frames():
+        for j, frame in frame_range(im, start_frame, end_frame):
+            if (j - start_frame) % stride == 0:
+                # convert makes a copy that the workers can own
+                yield j, frame.convert('RGB')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        if tiff:
+            with TiffImagePlugin.AppendingTiffWriter(path, True) as tf:
+                for j, frame in frames():
+                    pending.append(executor.submit(render, j, frame))
+                    while len(pending) > 2*workers or \
+                          (pending and pending[0].done()):
+                        pending.popleft().result().save(tf)
+                        tf.newFrame()
+                while pending:
+                    pending.popleft().result().save(tf)
+                    tf.newFrame()
+        else:
+            for j, frame in frames():
+                pending.append(executor.submit(render, j, frame))
+                while len(pending) > 2*workers:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+
+    return path
+
 def new_zip(points):
     '''Returns a list consisting of a list of x coordinates and a
         list of y coordinates when given a list of x,y tuples'''
@@ -144,15 +379,17 @@ def cluster_center(points):
     return [xavg, yavg]
 
 def plot_xy(spot_track, title, savefig = False):
-    '''launches a pylab plot of the list of x, y tuples in spot_track
-        and if savefig == True, it saves a copy of the file under title'''
+    '''launches a pylab plot of the list of x, y tuples (or Trajectory) in
+        spot_track and if savefig == True, it saves a copy of the file under
+        title'''
 
 
-    #converting the list of (x, y) tuples representing the centroid of the data
-    #in each frame into an array of the x coordinates and a list of the y coordinates
+    #viewing the (x, y) centroids of the data in each frame as an (n, 2)
+    #array; a Trajectory is not copied
     
-    x_track = pylab.array(new_zip(spot_track)[0])
-    y_track = pylab.array(new_zip(spot_track)[1])
+    xy = pylab.asarray(spot_track, dtype=float).reshape(-1, 2)
+    x_track = xy[:, 0]
+    y_track = xy[:, 1]
 
     #plotting the data
     
@@ -10,13 +10,16 @@ Author: Christopher Dydula, University of Toronto   -   18 May 2011
    Last Modification:  20 June 2011 by Christopher Dydula
 '''
 
-import os, json
+import os, sys, time, json, queue, argparse, threading
 import PILBeadTracking2 as pbt
 import TrapAnalysis as ta
+from Trajectory import Trajectory
+from TrajectoryCache import TrajectoryCache
 import numpy as np
 import tkinter as tk
 import tkinter.filedialog as tfd
 from matplotlib import pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
 def get_file(root):
     '''Ask for a filename and assign it to the global variable Tiff_file_name.
@@ -35,17 +38,62 @@ def get_dir(root):
         parent=root,
         title='Select directory to save frames to...'))
 
-def write_analysis_info(k, delk):
-    # Write out:
-        # trap stiffness, error
-        # analysis params (spot diameter, min brightness, max displacement, start frame, stop frame, T, delT, pize, delpsize)
-        # file path (TIFF) and output directory
-    analysis_info = {
-        'trap_stiffness_N_m'       : k,
-        'delta_trap_stiffness_N_m' : delk,
+# Default analysis parameters, as used by the GUI. The keys are those written
+# to analysis_info.txt, so a previous analysis_info.txt may be used as the
+# parameter file of a headless run.
+DEFAULT_PARAMS = {
+    'video_path'               : '',
+    'file_type'                : '8-bit',
+    'start_frame'              : 0,
+    'stop_frame'               : 100,
+    'first_spot'               : None,
+    'spot_radius'              : 7,
+    'max_displacement'         : 5,
+    'min_net_brightness'       : 150,
+    'frame_directory'          : '.',
+    'temperature_K'            : 293.15,
+    'delta_temperature_K'      : 5,
+    'pixel_size_um'            : 0.0619,
+    'delta_pixel_size_um'      : 0.0027,
+    'predict_spot'             : False,
+    'centroid_engine'          : 'average',
+    'decode_threads'           : 0,
+    'prefetch_depth'           : 8,
+    'chunks'                   : 0,
+    'frame_rate_Hz'            : None,
+    'exposure_time_s'          : None,
+    'converge_rel_error'       : None,
+    'cache_directory'          : os.path.join(os.path.expanduser('~'),
+                                              '.opt_trajectory_cache'),
+    'cache_size_mb'            : 500,
+    'checkpoint_interval_s'    : 30,
+    'binary_output'            : False,
+    'export_frames'            : False,
+    'export_stride'            : 1,
+    'export_scale'             : 1.0,
+}
+
+# The parameters that determine the tracked trajectory of a video, which
+# together with the video's contents key the trajectory cache.
+TRACKING_KEYS = ('start_frame', 'stop_frame', 'first_spot', 'spot_radius',
+                 'max_displacement', 'min_net_brightness', 'file_type',
+                 'predict_spot', 'centroid_engine')
+
+# The fewest tracked frames the GUI will analyze after tracking is
+# cancelled; fewer give no meaningful stiffness or plots.
+MIN_FRAMES = 10
+
+def gui_params():
+    '''Collect the analysis parameters entered in the GUI into a dictionary
+       with the same keys as DEFAULT_PARAMS.
+    '''
+
+    return {
         'video_path'               : Tiff_file_name.get(),
+        'file_type'                : file_type.get(),
         'start_frame'              : start_frame.get(),
         'stop_frame'               : stop_frame.get(),
+        'first_spot'               : None,
         'spot_radius'              : spot_size.get(),
         'max_displacement'         : max_displacement.get(),
         'min_net_brightness'       : min_net_brightness.get(),
@@ -54,34 +102,568 @@ def write_analysis_info(k, delk):
         'delta_temperature_K'      : deltemp.get(),
         'pixel_size_um'            : psize.get(),
         'delta_pixel_size_um'      : delpsize.get(),
+        'predict_spot'             : predict_spot.get(),
+        'centroid_engine'          : centroid_engine.get(),
+        'decode_threads'           : DEFAULT_PARAMS['decode_threads'],
+        'prefetch_depth'           : DEFAULT_PARAMS['prefetch_depth'],
+        'chunks'                   : DEFAULT_PARAMS['chunks'],
+        'frame_rate_Hz'            : DEFAULT_PARAMS['frame_rate_Hz'],
+        'exposure_time_s'          : DEFAULT_PARAMS['exposure_time_s'],
+        'converge_rel_error'       : DEFAULT_PARAMS['converge_rel_error'],
+        'cache_directory'          : DEFAULT_PARAMS['cache_directory'],
+        'cache_size_mb'            : DEFAULT_PARAMS['cache_size_mb'],
+        'checkpoint_interval_s'    : DEFAULT_PARAMS['checkpoint_interval_s'],
+        'binary_output'            : DEFAULT_PARAMS['binary_output'],
+        'export_frames'            : DEFAULT_PARAMS['export_frames'],
+        'export_stride'            : DEFAULT_PARAMS['export_stride'],
+        'export_scale'             : DEFAULT_PARAMS['export_scale'],
     }
 
-    with open(os.path.join(directory.get(), 'analysis_info.txt'), 'w') as f:
+def write_analysis_info(params, k, delk, recovered=None, extra=None, ci=None):
+    # Write out:
+        # trap stiffness, error, bootstrap confidence interval
+        # analysis params (spot diameter, min brightness, max displacement, start frame, stop frame, T, delT, pize, delpsize)
+        # file path (TIFF) and output directory
+    analysis_info = {
+        'trap_stiffness_N_m'       : k,
+        'delta_trap_stiffness_N_m' : delk,
+    }
+    if ci is not None:
+        # 95% block bootstrap interval, which allows for correlated frames
+        analysis_info['trap_stiffness_ci_N_m'] = [float(c) for c in ci]
+    analysis_info.update({
+        'video_path'               : params['video_path'],
+        'file_type'                : params['file_type'],
+        'start_frame'              : params['start_frame'],
+        'stop_frame'               : params['stop_frame'],
+        'first_spot'               : params['first_spot'],
+        'spot_radius'              : params['spot_radius'],
+        'max_displacement'         : params['max_displacement'],
+        'min_net_brightness'       : params['min_net_brightness'],
+        'predict_spot'             : params['predict_spot'],
+        'centroid_engine'          : params['centroid_engine'],
+        'frame_directory'          : params['frame_directory'],
+        'temperature_K'            : params['temperature_K'],
+        'delta_temperature_K'      : params['delta_temperature_K'],
+        'pixel_size_um'            : params['pixel_size_um'],
+        'delta_pixel_size_um'      : params['delta_pixel_size_um'],
+        'frame_rate_Hz'            : params['frame_rate_Hz'],
+        'exposure_time_s'          : params['exposure_time_s'],
+        'converge_rel_error'       : params['converge_rel_error'],
+        'binary_output'            : params['binary_output'],
+        'export_frames'            : params['export_frames'],
+        'export_stride'            : params['export_stride'],
+        'export_scale'             : params['export_scale'],
+    })
+    if extra is not None:
+        # stiffnesses from the correlations and power spectra
+        analysis_info.update(extra)
+    if recovered is not None:
+        # frames in which the predictive tracker found a lost bead again
+        analysis_info['recovered_frames'] = recovered
+
+    with open(os.path.join(params['frame_directory'], 'analysis_info.txt'), 'w') as f:
         f.write(
             json.dumps(analysis_info, indent=4, separators=(',', ': '))
         ) # use json.loads to do the reverse
+    return analysis_info
+
+def checkpoint_path(params):
+    '''Return the path of the tracking checkpoint in the output directory.'''
+    return os.path.join(params['frame_directory'], 'track_checkpoint.npz')
+
+def track(params, recovered=None, stats=None, im=None, resume=False,
+          progress=None, cancel=None, hash_progress=None):
+    '''Track the bead through the frames of the video given in params,
+       starting from params['first_spot']. Return the Trajectory of the bead
+       positions (pixels). If params['decode_threads'] is positive, frames
+       are decoded ahead of the tracker by that many background threads. If
+       params['predict_spot'] is true, the bead is searched for around its
+       predicted position and the frames in which it was found again after
+       being lost are appended to the list recovered.
+
+       The stiffness is accumulated as the bead is tracked in stats, a
+       TrapAnalysis.RunningStiffness, which is created if
+       params['converge_rel_error'] is set. Tracking then stops early once
+       the relative error of <r^2> falls below that value. im may be a
+       PILBeadTracking2.FrameSource to read the frames from instead.
+
+       Otherwise, trajectories are cached in params['cache_directory'] (if
+       set), so a video is only tracked again if its tracked frames or the
+       TRACKING_KEYS parameters have changed.
+
+       While tracking, the trajectory is checkpointed to
+       track_checkpoint.npz in params['frame_directory'] every
+       params['checkpoint_interval_s'] seconds and when tracking is
+       interrupted. If resume is True, tracking continues from the
+       checkpoint left by an interrupted run with the same parameters.
+
+       progress and cancel are passed on to PILBeadTracking2.track_spot; a
+       trajectory cut short by cancel is not cached. hash_progress, if
+       given, is called with the number of each frame read to key the cache
+       (see TrajectoryCache.file_hash).
+
+       If params['chunks'] is more than 1, the frame range is instead split
+       into that many chunks tracked in parallel processes by
+       PILBeadTracking2.track_spot_parallel, without checkpoints, progress
+       or cancel.
+    '''
+
+    cache = None
+    if im is None and stats is None and not params['converge_rel_error'] \
+       and params['cache_directory']:
+        cache = TrajectoryCache(params['cache_directory'],
+                                params['cache_size_mb'] * 2**20)
+        settings = dict((key, params[key]) for key in TRACKING_KEYS)
+        settings['first_spot'] = [float(c) for c in params['first_spot']]
+        if params['chunks'] > 1 and params['predict_spot']:
+            # stitched predictive chunks may differ slightly from one pass
+            settings['chunks'] = params['chunks']
+        key = cache.key(params['video_path'], settings, cancel,
+                        hash_progress)
+        if key is None:
+            # cancelled while reading the frames for the key
+            return Trajectory()
+        hit = cache.get(key)
+        if hit is not None:
+            print('Using the cached trajectory of %s' % params['video_path'])
+            spot_track, cached_recovered = hit
+            if recovered is not None and cached_recovered:
+                recovered.extend(cached_recovered)
+            return spot_track
+
+    if stats is None and params['converge_rel_error']:
+        stats = ta.RunningStiffness(params['temperature_K'],
+                                    params['pixel_size_um'],
+                                    params['delta_temperature_K'],
+                                    params['delta_pixel_size_um'],
+                                    params['converge_rel_error'])
+    if im is None and stats is None and params['chunks'] > 1:
+        spot_track = pbt.track_spot_parallel(
+            params['video_path'], params['first_spot'],
+            params['max_displacement'], params['spot_radius'],
+            params['min_net_brightness'], params['start_frame'],
+            params['stop_frame'], params['file_type'],
+            predict=params['predict_spot'], recovered=recovered,
+            engine=params['centroid_engine'], n_chunks=params['chunks'])
+        if cache is not None:
+            cache.put(key, spot_track, recovered)
+        return spot_track
+
+    if im is None:
+        if params['decode_threads'] > 0:
+            im = pbt.PrefetchFrameSource(params['video_path'],
+                                         params['decode_threads'],
+                                         params['prefetch_depth'])
+        else:
+            im = pbt.FrameSource(params['video_path'])
+    spot_track = pbt.track_spot(
+        im, params['first_spot'], params['max_displacement'],
+        params['spot_radius'], params['min_net_brightness'],
+        params['start_frame'], params['stop_frame'], params['file_type'],
+        predict=params['predict_spot'], recovered=recovered,
+        engine=params['centroid_engine'], stats=stats,
+        checkpoint=checkpoint_path(params),
+        checkpoint_interval=params['checkpoint_interval_s'], resume=resume,
+        progress=progress, cancel=cancel)
+    if cache is not None and not (cancel is not None and cancel.is_set()):
+        cache.put(key, spot_track, recovered)
+    return spot_track
+
+def analyze_track(params, spot_track, recovered=None):
+    '''Calculate the trap stiffness from the tracked bead positions and write
+       position_data.txt, fig1.png to fig3.png and analysis_info.txt to
+       params['frame_directory']. If params['binary_output'] is true, the
+       positions are instead saved with their frame numbers, found flags
+       and the analysis info to trajectory.npy and trajectory.json (see
+       Trajectory.save). Return a dictionary of the results.
+       recovered is the list of frames recovered by the predictive tracker,
+       if it was used. The stiffness is also estimated from the relaxation
+       of the position autocorrelations, from the plateau of their
+       mean-squared displacements and, if params['frame_rate_Hz'] is given,
+       from the power spectra of the positions.
+    '''
+
+    start = params['start_frame']
+    stop = params['stop_frame']
+    directory = params['frame_directory']
+
+    # tracking may have stopped early, once the stiffness converged
+    n = min(stop - start, len(spot_track))
+    # views of the positions of a Trajectory, not copies
+    xy = np.asarray(spot_track, dtype=float).reshape(-1, 2)[:n]
+    x = xy[:, 0]
+    y = xy[:, 1]
+
+    # x is an array_like type holding the x positions of each frame and y
+    # is holding the y positions of each frame. The remaining code may be
+    # edited to analyze this data however one wishes.
 
+    # save raw position data (units of PIXELS here)
+    if not params['binary_output']:
+        np.savetxt(os.path.join(directory, 'position_data.txt'), xy, delimiter='\t', header='x\ty\t', comments='')
+
+    # zero-mean positions in metres for the correlations and power spectra
+    psize_m = params['pixel_size_um'] * 1e-6
+    x_m = (x - np.mean(x)) * psize_m
+    y_m = (y - np.mean(y)) * psize_m
+
+    # the exposure as a fraction of the frame period, for the blur correction
+    exposure = 1.0
+    if params['frame_rate_Hz'] and params['exposure_time_s'] is not None:
+        exposure = params['exposure_time_s'] * params['frame_rate_Hz']
+    extra = ta.acf_stiffness(x_m, y_m, params['temperature_K'], exposure)
+    # and from the plateau of the mean-squared displacements
+    extra.update(ta.msd_stiffness(x_m, y_m, params['temperature_K'], extra))
+    if n < stop - start:
+        extra['frames_analyzed'] = n
+
+    if params['frame_rate_Hz']:
+        extra.update(ta.psd_stiffness(x_m, y_m, params['frame_rate_Hz'],
+                                      params['temperature_K'],
+                                      params['exposure_time_s']))
+
+    # a fixed seed keeps the interval reproducible from analysis_info.txt
+    ci = ta.bootstrap_stiffness(x_m, y_m, params['temperature_K'], seed=0)
+
+    # r is the trap stiffness, delta is the error in the result
+    (r, delta, figs) = ta.analyze(x, y, params['temperature_K'],
+                                  params['pixel_size_um'],
+                                  params['delta_temperature_K'],
+                                  params['delta_pixel_size_um'],
+                                  params['frame_rate_Hz'])
+
+    for i, fig in enumerate(figs):
+        fig.savefig(os.path.join(directory, 'fig%d.png' % (i + 1)))
+    plt.close('all')
+
+    # Write out analysis info for ease of reproducibility
+    info = write_analysis_info(params, r, delta, recovered, extra, ci)
+
+    if params['binary_output']:
+        if not isinstance(spot_track, Trajectory):
+            spot_track = Trajectory.from_arrays(spot_track)
+        traj = spot_track[:n]
+        traj.metadata['analysis_info'] = info
+        traj.save(os.path.join(directory, 'trajectory.npy'))
+
+    result = {
+        'trap_stiffness_N_m'       : r,
+        'delta_trap_stiffness_N_m' : delta,
+        'trap_stiffness_ci_N_m'    : ci,
+        'spot_track'               : spot_track,
+        'recovered_frames'         : recovered,
+    }
+    result.update(extra)
+    return result
+
+def export_track(params, spot_track):
+    '''Write every params['export_stride']-th tracked frame, downscaled by
+       params['export_scale'] and marked where the bead was found, to
+       tracked_frames.tif in params['frame_directory']. Return its path.
+    '''
+
+    path = os.path.join(params['frame_directory'], 'tracked_frames.tif')
+    # 2 is the size in pixels of the dot showing tracking results.
+    # Originally a variable was passed.
+    return pbt.export_frames(pbt.Image.open(params['video_path']), path,
+                             spot_track, params['start_frame'],
+                             params['stop_frame'], 2,
+                             params['export_stride'], params['export_scale'])
+
+def spot_key(params):
+    return '%s|%d' % (os.path.abspath(params['video_path']),
+                      params['start_frame'])
+
+def last_spot(params):
+    '''Return the first spot last used for the video and start frame in
+       params, as remembered by remember_spot, or None.
+    '''
+
+    if not params['cache_directory']:
+        return None
+    try:
+        with open(os.path.join(params['cache_directory'],
+                               'last_spots.json')) as f:
+            return json.load(f).get(spot_key(params))
+    except (IOError, ValueError):
+        return None
+
+def remember_spot(params):
+    '''Remember params['first_spot'] for the video and start frame in
+       params, in last_spots.json in the trajectory cache directory, so that
+       a re-analysis can reuse it and therefore the cached trajectory.
+    '''
+
+    if not params['cache_directory']:
+        return
+    path = os.path.join(params['cache_directory'], 'last_spots.json')
+    try:
+        with open(path) as f:
+            spots = json.load(f)
+    except (IOError, ValueError):
+        spots = {}
+    spots[spot_key(params)] = [float(c) for c in params['first_spot']]
+    if not os.path.isdir(params['cache_directory']):
+        os.makedirs(params['cache_directory'])
+    with open(path, 'w') as f:
+        json.dump(spots, f, indent=1)
+
+def detect_spot(params, im=None):
+    '''Locate the bead automatically in the start frame of the video given
+       in params, or of the FrameSource im. Return the [x, y] position of the
+       brightest candidate bead found by PILBeadTracking2.detect_beads, or
+       None if there is none.
+    '''
+
+    if im is None:
+        im = pbt.FrameSource(params['video_path'])
+    frames = list(im.frames(params['start_frame'], params['start_frame']))
+    if not frames:
+        return None
+    spots = pbt.detect_beads(frames[0][1],
+                             params['min_net_brightness'],
+                             params['file_type'], params['spot_radius'])
+    if not spots:
+        return None
+    return [float(spots[0][0]), float(spots[0][1])]
+
+def run_analysis(params, resume=False):
+    '''Track the bead and analyze the trap without a GUI. params is a
+       dictionary with the keys of DEFAULT_PARAMS; missing keys take their
+       default values. 'video_path' must be given. If no 'first_spot' is
+       given, the bead is located automatically in the start frame. The
+       output files are written to params['frame_directory'] and a
+       dictionary of the results is returned. If params['export_frames'] is
+       true, the tracked frames are also exported (see export_track). If
+       resume is True, an interrupted run writing to the same directory is
+       continued.
+    '''
+
+    params = dict(DEFAULT_PARAMS, **params)
+    if not params['video_path']:
+        raise ValueError('no video_path given')
+    if params['first_spot'] is None:
+        params['first_spot'] = detect_spot(params)
+        if params['first_spot'] is None:
+            raise ValueError('no bead found in frame %d of %s'
+                             % (params['start_frame'], params['video_path']))
+    if not os.path.isdir(params['frame_directory']):
+        os.makedirs(params['frame_directory'])
+
+    recovered = [] if params['predict_spot'] else None
+    spot_track = track(params, recovered, resume=resume)
+    if params['export_frames']:
+        export_track(params, spot_track)
+    return analyze_track(params, spot_track, recovered)
+
+class LiveWriter(object):
+    '''Records a bead position as it is tracked: each position is passed on
+       to stats, a TrapAnalysis.RunningStiffness, and appended to
+       live_position_data.txt in directory. At least every flush_every
+       positions or flush_interval seconds the positions are flushed to disk
+       and the running stiffness is appended to live_stiffness.txt, so that
+       both can be followed while the video is still being recorded. Used
+       as the stats of PILBeadTracking2.track_spot.
+    '''
+
+    def __init__(self, directory, stats, flush_every=100, flush_interval=1.0):
+        self.stats = stats
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.positions = open(os.path.join(directory,
+                                           'live_position_data.txt'), 'w')
+        self.positions.write('x\ty\t\n')
+        self.running = open(os.path.join(directory, 'live_stiffness.txt'),
+                            'w')
+        self.running.write('frames\ttrap_stiffness_N_m\t'
+                           'delta_trap_stiffness_N_m\n')
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def add(self, x, y):
+        '''Add the position (x, y). Return True once the stiffness has
+           converged, as RunningStiffness.add.
+        '''
+        self.buffer.append((x, y))
+        done = self.stats.add(x, y)
+        if len(self.buffer) >= self.flush_every or \
+           time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return done
+
+    def flush(self):
+        '''Write out the buffered positions and the running stiffness.'''
+        if self.buffer:
+            np.savetxt(self.positions, self.buffer, delimiter='\t')
+            self.buffer = []
+            k, delk = self.stats.stiffness()
+            self.running.write('%d\t%9.4e\t%9.4e\n' % (self.stats.n, k, delk))
+        self.positions.flush()
+        self.running.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.positions.close()
+        self.running.close()
+
+def run_watch(params, timeout=10.0, flush_every=100, flush_interval=1.0):
+    '''Track the bead in a video while it is being recorded, then analyze
+       the trap as run_analysis does. params['video_path'] is either a TIFF
+       stack that is being appended to or a directory into which each frame
+       is written as a TIFF file. Frames are tracked as soon as they are
+       written, until params['stop_frame'], until no new frame has been
+       written for timeout seconds, or until the stiffness has converged to
+       params['converge_rel_error']. The positions and running stiffness are
+       written out while tracking, as by LiveWriter.
+    '''
+
+    params = dict(DEFAULT_PARAMS, **params)
+    if not params['video_path']:
+        raise ValueError('no video_path given')
+    if not os.path.isdir(params['frame_directory']):
+        os.makedirs(params['frame_directory'])
+
+    im = pbt.WatchFrameSource(params['video_path'], timeout=timeout)
+    if params['first_spot'] is None:
+        params['first_spot'] = detect_spot(params, im)
+        if params['first_spot'] is None:
+            raise ValueError('no bead found in frame %d of %s'
+                             % (params['start_frame'], params['video_path']))
+
+    stats = ta.RunningStiffness(params['temperature_K'],
+                                params['pixel_size_um'],
+                                params['delta_temperature_K'],
+                                params['delta_pixel_size_um'],
+                                params['converge_rel_error'])
+    live = LiveWriter(params['frame_directory'], stats, flush_every,
+                      flush_interval)
+    recovered = [] if params['predict_spot'] else None
+    try:
+        spot_track = track(params, recovered, live, im)
+    finally:
+        live.close()
+    return analyze_track(params, spot_track, recovered)
+
+class ProgressReporter(object):
+    '''Posts the progress of tracking the frames [start_frame, stop_frame]
+       to the queue messages as ('progress', stage, frames done, frames in
+       total, frames/s, seconds left), at most once every interval seconds.
+       Used as the progress of PILBeadTracking2.track_spot, so it is called
+       on the tracking thread while the GUI reads the queue, and with
+       stage 'Hashing frames for the cache' as the progress of
+       TrajectoryCache.file_hash.
+    '''
+
+    def __init__(self, messages, start_frame, stop_frame, interval=0.25,
+                 stage='Tracking'):
+        self.messages = messages
+        self.stage = stage
+        self.start_frame = max(start_frame, 0)
+        self.total = stop_frame - self.start_frame + 1
+        self.interval = interval
+        self.first = None
+        self.last_post = 0.0
+
+    def __call__(self, i):
+        now = time.time()
+        if self.first is None:
+            # frames/s from the first frame tracked, which is later than
+            # start_frame when resuming
+            self.first = (i, now)
+        if now - self.last_post < self.interval:
+            return
+        self.last_post = now
+        done = i - self.start_frame + 1
+        elapsed = now - self.first[1]
+        rate = (i - self.first[0]) / elapsed if elapsed > 0 else 0.0
+        left = (self.total - done) / rate if rate > 0 else float('nan')
+        self.messages.put(('progress', self.stage, done, self.total, rate,
+                           left))
+
+def tracking_job(params, recovered, messages, cancel, export=False):
+    '''Track the bead (and export the tracked frames if export is True) on
+       a worker thread of the GUI, posting progress to the queue messages
+       and finally ('tracked', spot_track, path of the exported frames) or
+       ('error', message). Tracking stops early, keeping the frames tracked
+       so far, once the threading.Event cancel is set. The GUI cannot
+       resume, so the checkpoint of a cancelled run is then deleted.
+    '''
+
+    try:
+        progress = ProgressReporter(messages, params['start_frame'],
+                                    params['stop_frame'])
+        hash_progress = ProgressReporter(messages, params['start_frame'],
+                                         params['stop_frame'],
+                                         stage='Hashing frames for the cache')
+        spot_track = track(params, recovered, progress=progress,
+                           cancel=cancel, hash_progress=hash_progress)
+        if cancel.is_set() and os.path.isfile(checkpoint_path(params)):
+            os.remove(checkpoint_path(params))
+        path = None
+        if export and len(spot_track):
+            messages.put(('status', ">>> Saving frames..."))
+            path = export_track(params, spot_track)
+        messages.put(('tracked', spot_track, path))
+    except Exception as e:
+        messages.put(('error', '%s: %s' % (type(e).__name__, e)))
+
+def analysis_job(params, spot_track, recovered, messages):
+    '''Analyze the tracked positions on a worker thread of the GUI, posting
+       ('result', result dictionary) or ('error', message) to messages.
+    '''
+
+    try:
+        messages.put(('result', analyze_track(params, spot_track, recovered)))
+    except Exception as e:
+        messages.put(('error', '%s: %s' % (type(e).__name__, e)))
+
+def format_seconds(t):
+    '''Return t seconds as minutes:seconds, or ? if t is nan.'''
+    if t != t:
+        return '?'
+    return '%d:%02d' % divmod(int(round(t)), 60)
 
 def analyze():
     '''Collect the x and y positions of the bead to be tracked in each frame
        and calculate the trap stiffness from this data. Various data plots are
        displayed. Option to display and/or save tracked frames.
-    '''
-
-    #____Collecting the data___#
 
-    im = pbt.Image.open(Tiff_file_name.get())
+       Tracking and the analysis run on a worker thread (see tracking_job
+       and analysis_job), so the window stays responsive; poll_analysis
+       shows their progress. The Cancel button stops tracking and analyzes
+       the frames tracked so far.
+    '''
 
-    # finding the initial location of the spot by creating an Image_clicker
-    # object
+    params = gui_params()
 
-    dialog_text.set(">>> Select spot location (may take a while if saving or"
-                    " displaying frames)")
+    #____Collecting the data___#
 
-    first_image = pbt.ImageSequence.Iterator(im)[start_frame.get()]
-    clicker = pbt.Image_clicker(first_image, window)
-    first_spot = clicker.click
-    clicker.root.destroy()
+    if spot_location.get() == "Reuse last spot":
+        # the same spot keys the same cached trajectory, so only the
+        # analysis is repeated
+        params['first_spot'] = last_spot(params)
+    if spot_location.get() == "Detect spot":
+        params['first_spot'] = detect_spot(params)
+        if params['first_spot'] is None:
+            dialog_text.set(">>> No bead found in the start frame. Check the"
+                            " spot parameters or click the spot instead")
+            return
+    elif params['first_spot'] is None:
+        im = pbt.Image.open(params['video_path'])
+
+        # finding the initial location of the spot by creating an
+        # Image_clicker object
+
+        dialog_text.set(">>> Select spot location (may take a while if saving"
+                        " or displaying frames)")
+
+        first_image = pbt.ImageSequence.Iterator(im)[params['start_frame']]
+        clicker = pbt.Image_clicker(first_image, window)
+        params['first_spot'] = clicker.click
+        clicker.root.destroy()
+    remember_spot(params)
 
     # a grid is no longer used to find initial spot location
     '''
@@ -94,67 +676,375 @@ def analyze():
     dialog_text.set(">>> Tracking...")
 
     # obtain bead position data
-    spot_track = pbt.track_spot(im, first_spot, max_displacement.get(),
-                            spot_size.get(), min_net_brightness.get(),
-                            start_frame.get(), stop_frame.get(),
-                            file_type.get()) 
-    dialog_text.set(">>> Tracking complete.")
+    recovered = [] if params['predict_spot'] else None
+    messages = queue.Queue()
+    cancel_event.clear()
+    start_button.config(state=tk.DISABLED)
+    cancel_button.config(state=tk.NORMAL)
+    worker = threading.Thread(target=tracking_job,
+                              args=(params, recovered, messages, cancel_event,
+                                    save_or_display.get() == "Save frames"))
+    worker.daemon = True
+    worker.start()
+    window.after(100, poll_analysis, params, recovered, messages)
+
+def poll_analysis(params, recovered, messages):
+    '''Show the messages posted by tracking_job and analysis_job, then poll
+       again after 100 ms until the analysis is finished.
+    '''
 
-    #___Displaying and saving the data___#
+    while True:
+        try:
+            message = messages.get_nowait()
+        except queue.Empty:
+            break
+
+        if message[0] == 'progress':
+            stage, done, total, rate, left = message[1:]
+            dialog_text.set(">>> %s... %d of %d frames, %.1f frames/s,"
+                            " %s left" % (stage, done, total, rate,
+                                          format_seconds(left)))
+        elif message[0] == 'status':
+            dialog_text.set(message[1])
+        elif message[0] == 'tracked':
+            spot_track, directory1 = message[1:]
+            cancel_button.config(state=tk.DISABLED)
+            if len(spot_track) < MIN_FRAMES:
+                dialog_text.set(">>> Tracking cancelled before enough frames"
+                                " were tracked (at least %d are needed)"
+                                % MIN_FRAMES)
+                start_button.config(state=tk.NORMAL)
+                return
+            # after cancelling, analyze_track analyzes the frames tracked so
+            # far and records how many there were
+            show_frames(params, spot_track, directory1)
+
+            #___Analyzing the data___#
+
+            dialog_text.set(">>> Analyzing...")
+            worker = threading.Thread(target=analysis_job,
+                                      args=(params, spot_track, recovered,
+                                            messages))
+            worker.daemon = True
+            worker.start()
+        elif message[0] == 'result':
+            result = message[1]
+            print("The trap stiffness is "
+                  "%9.4e +/- %9.4e N/m" % (result['trap_stiffness_N_m'],
+                                           result['delta_trap_stiffness_N_m']))
+            dialog_text.set(">>> The trap stiffness is %9.4e +/- %9.4e N/m"
+                            % (result['trap_stiffness_N_m'],
+                               result['delta_trap_stiffness_N_m']))
+            start_button.config(state=tk.NORMAL)
+            return
+        elif message[0] == 'error':
+            dialog_text.set(">>> Analysis failed: %s" % message[1])
+            cancel_button.config(state=tk.DISABLED)
+            start_button.config(state=tk.NORMAL)
+            return
+
+    window.after(100, poll_analysis, params, recovered, messages)
+
+def show_frames(params, spot_track, directory1=None):
+    '''Show the tracked frames, from the exported tracked_frames.tif
+       directory1 if "Save frames" was chosen, so the user can check that
+       the bead was tracked correctly.
+    '''
 
-    if save_or_display.get() in ["Display frames", "Save frames"]:
-        im = pbt.Image.open(Tiff_file_name.get())
-        dialog_text.set(">>> Saving frames...")
+    #___Displaying and saving the data___#
 
-        # 2 is the size in pixels of the dot showing tracking results.
-        # Originally a variable was passed.
-        directory1 = pbt.save_frame(im, directory.get(), spot_track,
-                                    start_frame.get(), stop_frame.get(), 2)
-        dialog_text.set(">>> Saving frames complete.")
+    if save_or_display.get() == "Save frames":
         dialog_text.set(">>> Check to see if the bead was tracked correctly."
-                        " Close the popup to continue (may take a while if"
-                        " not saving frames)")
-        display = pbt.Display_Results(directory1, plot_title, start_frame.get(),
-                        stop_frame.get(), save_or_display.get() == "Save frames", window)
+                        " Close the popup to continue")
+        display = pbt.Display_Results(directory1, plot_title,
+                        params['start_frame'], params['stop_frame'],
+                        True, window, params['export_stride'])
+        display.root.destroy()
+    elif save_or_display.get() == "Display frames":
+        # frames are rendered from the video as they are shown
+        frames = pbt.FrameCache(params['video_path'], spot_track,
+                                params['start_frame'], 2)
+        dialog_text.set(">>> Check to see if the bead was tracked correctly."
+                        " Close the popup to continue")
+        display = pbt.Display_Results(frames, plot_title,
+                        params['start_frame'],
+                        min(params['stop_frame'], frames.last_frame()),
+                        False, window)
         display.root.destroy()
 
-    #___Analyzing the data___#
-
-    x = np.zeros((stop_frame.get() - start_frame.get()))
-    y = np.zeros((stop_frame.get() - start_frame.get()))
-    for i in range(stop_frame.get() - start_frame.get()):
-        x[i] = spot_track[i][0]
-        y[i] = spot_track[i][1]
-
-    # x is an array_like type holding the x positions of each frame and y
-    # is holding the y positions of each frame. The remaining code may be
-    # edited to analyze this data however one wishes.
+def batch_job(params):
+    '''Run the analysis of a single video of a batch in a worker process.
+       Return the video's row of the aggregated results table.
+    '''
 
-    # save raw position data (units of PIXELS here)
-    xy = np.column_stack([x, y])
-    np.savetxt(os.path.join(directory.get(), 'position_data.txt'), xy, delimiter='\t', header='x\ty\t', comments='')
+    plt.switch_backend('Agg')
+    row = {
+        'video_path'               : params['video_path'],
+        'frame_directory'          : params['frame_directory'],
+        'trap_stiffness_N_m'       : float('nan'),
+        'delta_trap_stiffness_N_m' : float('nan'),
+        'error'                    : '',
+    }
+    try:
+        result = run_analysis(params)
+    except Exception as e:
+        # one bad video should not stop the rest of the batch
+        row['error'] = '%s: %s' % (type(e).__name__, e)
+    else:
+        row['trap_stiffness_N_m'] = result['trap_stiffness_N_m']
+        row['delta_trap_stiffness_N_m'] = result['delta_trap_stiffness_N_m']
+    return row
+
+def batch_params(manifest, defaults=None):
+    '''Return the list of parameter dictionaries of the videos in a batch
+       manifest and the default output directory. The manifest is either a
+       list of parameter dictionaries or a dictionary with a 'videos' list
+       and optional 'defaults' shared by all videos. Videos without a
+       'frame_directory' of their own are written to a subdirectory, named
+       after the video, of the default directory.
+    '''
 
-    # r is the trap stiffness, delta is the error in the result
-    (r, delta, figs) = ta.analyze(x, y, temp.get(), psize.get(), deltemp.get(), delpsize.get())
+    if isinstance(manifest, dict):
+        videos = manifest['videos']
+        shared = dict(manifest.get('defaults', {}))
+    else:
+        videos = manifest
+        shared = {}
+    shared.update(defaults or {})
+    out_dir = shared.get('frame_directory', DEFAULT_PARAMS['frame_directory'])
+
+    jobs = []
+    names = set()
+    for video in videos:
+        params = dict(DEFAULT_PARAMS, **shared)
+        params.update(video)
+        if 'frame_directory' not in video:
+            name = os.path.splitext(os.path.basename(params['video_path']))[0]
+            unique = name
+            i = 1
+            while unique in names:
+                unique = '%s-%d' % (name, i)
+                i += 1
+            names.add(unique)
+            params['frame_directory'] = os.path.join(out_dir, unique)
+        jobs.append(params)
+    return jobs, out_dir
+
+def run_batch(manifest, max_workers=None, defaults=None):
+    '''Analyze all videos of a batch manifest (see batch_params) in parallel
+       on a pool of max_workers processes (one per core by default). Each
+       video's outputs are written as by run_analysis, and the table of trap
+       stiffnesses of all videos is written to batch_results.txt in the
+       default output directory. Return the rows of that table.
+    '''
 
-    figs[0].savefig(os.path.join(directory.get(), 'fig1.png'))
-    figs[1].savefig(os.path.join(directory.get(), 'fig2.png'))
-    plt.close('all')
+    jobs, out_dir = batch_params(manifest, defaults)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        rows = list(executor.map(batch_job, jobs))
+
+    with open(os.path.join(out_dir, 'batch_results.txt'), 'w') as f:
+        f.write('video_path\tframe_directory\ttrap_stiffness_N_m\t'
+                'delta_trap_stiffness_N_m\terror\n')
+        for row in rows:
+            f.write('%s\t%s\t%.6e\t%.6e\t%s\n' % (
+                row['video_path'], row['frame_directory'],
+                row['trap_stiffness_N_m'], row['delta_trap_stiffness_N_m'],
+                row['error']))
+
+    return rows
+
+def parse_args(argv):
+    '''Parse the command line arguments of a headless run into a dictionary
+       of analysis parameters and a dictionary of the remaining options.
+       Values given on the command line override those of the parameter
+       file.
+    '''
 
-    # Write out analysis info for ease of reproducibility
-    write_analysis_info(r, delta)
+    parser = argparse.ArgumentParser(
+        description='Track a trapped bead in a TIFF video and calculate the'
+                    ' trap stiffness without the GUI.')
+    parser.add_argument('params_file', nargs='?',
+                        help='JSON parameter file, e.g. a previous'
+                             ' analysis_info.txt')
+    parser.add_argument('--video', dest='video_path')
+    parser.add_argument('--file-type', dest='file_type',
+                        choices=['8-bit', 'RGB'])
+    parser.add_argument('--start-frame', dest='start_frame', type=int)
+    parser.add_argument('--stop-frame', dest='stop_frame', type=int)
+    parser.add_argument('--spot', dest='first_spot', type=float, nargs=2,
+                        metavar=('X', 'Y'),
+                        help='initial location of the spot (pixels); if not'
+                             ' given, the bead is detected automatically')
+    parser.add_argument('--spot-radius', dest='spot_radius', type=int)
+    parser.add_argument('--max-displacement', dest='max_displacement',
+                        type=int)
+    parser.add_argument('--min-net-brightness', dest='min_net_brightness',
+                        type=int)
+    parser.add_argument('--predict', dest='predict_spot', action='store_true',
+                        default=None,
+                        help='search around the predicted spot position and'
+                             ' recover the spot when it is lost')
+    parser.add_argument('--centroid', dest='centroid_engine',
+                        choices=pbt.TRACKER_ENGINES,
+                        help='how the spot is located in the search box:'
+                             ' average (default), weighted, radial,'
+                             ' gaussian or template (cross-correlation)')
+    parser.add_argument('--output', dest='frame_directory',
+                        help='directory to write the results to')
+    parser.add_argument('--temperature', dest='temperature_K', type=float)
+    parser.add_argument('--delta-temperature', dest='delta_temperature_K',
+                        type=float)
+    parser.add_argument('--pixel-size', dest='pixel_size_um', type=float)
+    parser.add_argument('--delta-pixel-size', dest='delta_pixel_size_um',
+                        type=float)
+    parser.add_argument('--decode-threads', dest='decode_threads', type=int,
+                        help='number of threads decoding frames ahead of the'
+                             ' tracker (default: 0, decode on the tracking'
+                             ' thread)')
+    parser.add_argument('--prefetch-depth', dest='prefetch_depth', type=int,
+                        help='maximum number of frames queued per decoding'
+                             ' thread')
+    parser.add_argument('--chunks', dest='chunks', type=int,
+                        help='track the frame range in this many chunks in'
+                             ' parallel processes (default: 0, track it in'
+                             ' one pass); no checkpoints are written')
+    parser.add_argument('--frame-rate', dest='frame_rate_Hz', type=float,
+                        help='frame rate of the video (Hz); also estimates'
+                             ' the stiffness from the power spectra')
+    parser.add_argument('--exposure', dest='exposure_time_s', type=float,
+                        help='exposure time of each frame (s) for the motion'
+                             ' blur correction of the power spectra'
+                             ' (default: 1/frame rate, 0 for none)')
+    parser.add_argument('--converge', dest='converge_rel_error', type=float,
+                        metavar='REL_ERROR',
+                        help='stop tracking once the relative error of <r^2>'
+                             ' falls below REL_ERROR')
+    parser.add_argument('--cache-dir', dest='cache_directory',
+                        help='directory of cached trajectories (default:'
+                             ' ~/.opt_trajectory_cache)')
+    parser.add_argument('--cache-size', dest='cache_size_mb', type=float,
+                        help='size limit of the trajectory cache (MB)')
+    parser.add_argument('--no-cache', dest='cache_directory',
+                        action='store_const', const='',
+                        help='always track the video again')
+    parser.add_argument('--checkpoint-interval', dest='checkpoint_interval_s',
+                        type=float,
+                        help='seconds between checkpoints of the trajectory'
+                             ' while tracking (default: 30)')
+    parser.add_argument('--binary', dest='binary_output', action='store_true',
+                        default=None,
+                        help='save the positions to trajectory.npy and'
+                             ' trajectory.json instead of position_data.txt')
+    parser.add_argument('--export-frames', dest='export_frames',
+                        action='store_true', default=None,
+                        help='write the tracked frames, marked where the bead'
+                             ' was found, to tracked_frames.tif')
+    parser.add_argument('--export-stride', dest='export_stride', type=int,
+                        help='with --export-frames, only write every Nth'
+                             ' frame (default: 1)')
+    parser.add_argument('--export-scale', dest='export_scale', type=float,
+                        help='with --export-frames, downscale the frames by'
+                             ' this factor (default: 1)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run from its'
+                             ' checkpoint in the output directory')
+    parser.add_argument('--watch', action='store_true',
+                        help='track the video while it is being recorded:'
+                             ' --video is a growing TIFF stack or a directory'
+                             ' of single-frame TIFFs')
+    parser.add_argument('--watch-timeout', type=float, default=10.0,
+                        help='with --watch, stop once no new frame has been'
+                             ' written for this many seconds (default: 10)')
+    parser.add_argument('--batch', metavar='MANIFEST',
+                        help='JSON manifest of videos to analyze in parallel;'
+                             ' the other parameters are used as defaults')
+    parser.add_argument('--workers', type=int,
+                        help='number of worker processes for --batch'
+                             ' (default: one per core)')
+    args = vars(parser.parse_args(argv))
+    options = {
+        'batch'         : args.pop('batch'),
+        'workers'       : args.pop('workers'),
+        'watch'         : args.pop('watch'),
+        'watch_timeout' : args.pop('watch_timeout'),
+        'resume'        : args.pop('resume'),
+    }
 
-    #dialog_text.set("The trap stiffness in the x direction is %9.4e N/m" % x1)
-    #dialog_text.set(dialog_text.get()
-    #           + "\nThe trap stiffness in the y direction is %9.4e N/m" % y1)
+    params = {}
+    params_file = args.pop('params_file')
+    if params_file is not None:
+        with open(params_file) as f:
+            params.update(json.load(f))
+    params.update((key, value) for key, value in args.items()
+                  if value is not None)
+
+    # drop results of a previous analysis read from analysis_info.txt
+    params = dict((key, value) for key, value in params.items()
+                  if key in DEFAULT_PARAMS)
+    return params, options
+
+def main(argv):
+    '''Run a headless analysis from the command line.'''
+
+    plt.switch_backend('Agg')
+    params, options = parse_args(argv)
+
+    if options['batch'] is not None:
+        with open(options['batch']) as f:
+            manifest = json.load(f)
+        rows = run_batch(manifest, options['workers'], params)
+        for row in rows:
+            if row['error']:
+                print("%s: failed (%s)" % (row['video_path'], row['error']))
+            else:
+                print("%s: %9.4e +/- %9.4e N/m" % (row['video_path'],
+                      row['trap_stiffness_N_m'],
+                      row['delta_trap_stiffness_N_m']))
+        return
+
+    if options['watch']:
+        result = run_watch(params, options['watch_timeout'])
+    else:
+        result = run_analysis(params, options['resume'])
     print("The trap stiffness is "
-                    "%9.4e +/- %9.4e N/m" % (r, delta))
-    
+          "%9.4e +/- %9.4e N/m" % (result['trap_stiffness_N_m'],
+                                   result['delta_trap_stiffness_N_m']))
+    print("95%% bootstrap confidence interval: "
+          "%9.4e to %9.4e N/m" % result['trap_stiffness_ci_N_m'])
+    for name in ('x', 'y'):
+        print("From the %s autocorrelation: tau = %.4g frames, "
+              "k = %9.4e N/m" % (name,
+              result['relaxation_time_%s_frames' % name],
+              result['acf_trap_stiffness_%s_N_m' % name]))
+        print("From the %s mean-squared displacement: MSD(1 frame) = "
+              "%.4g m^2, plateau = %.4g m^2, k = %9.4e N/m" % (name,
+              result['msd_lag1_%s_m2' % name],
+              result['msd_plateau_%s_m2' % name],
+              result['msd_trap_stiffness_%s_N_m' % name]))
+    if 'corner_frequency_x_Hz' in result:
+        for name in ('x', 'y'):
+            print("From the %s power spectrum: fc = %.4g Hz, "
+                  "k = %9.4e N/m" % (name,
+                  result['corner_frequency_%s_Hz' % name],
+                  result['psd_trap_stiffness_%s_N_m' % name]))
+
 def update(): # unused
     waiter.set(1)
 
 if __name__ == "__main__":
 
+    # with any command line arguments, run without the GUI
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+        sys.exit()
+
+    # figures are only saved, never shown, so they can be drawn by the
+    # analysis worker thread
+    plt.switch_backend('Agg')
+
     # Create the application
     window = tk.Tk()
     window.wm_title("Optical Trap Video Analysis")
@@ -270,6 +1160,39 @@ if __name__ == "__main__":
     entry = tk.Entry(param_frame, textvariable=min_net_brightness, width=4)
     entry.grid(row=2, column=5, padx=1, sticky=tk.W)
 
+    # the initial spot location is either clicked on the start frame,
+    # detected automatically from the spot parameters or that of the
+    # previous analysis of the video (clicked if there was none)
+    spot_location = tk.StringVar()
+    spot_location.set("Click spot")
+
+    label = tk.Label(param_frame, text="Initial spot location:")
+    label.grid(row=3, column=0, sticky=tk.W)
+
+    optmenu = tk.OptionMenu(param_frame, spot_location, "Click spot",
+                            "Detect spot", "Reuse last spot")
+    optmenu.grid(row=3, column=1, columnspan=2, sticky=tk.W)
+
+    # search around the predicted spot position and recover lost spots
+    predict_spot = tk.BooleanVar()
+    predict_spot.set(False)
+
+    checkbutton = tk.Checkbutton(param_frame, variable=predict_spot,
+                                 text="Predict spot position")
+    checkbutton.grid(row=3, column=3, columnspan=2, sticky=tk.W)
+
+    # how the spot is located within the search box (see
+    # PILBeadTracking2.TRACKER_ENGINES)
+    centroid_engine = tk.StringVar()
+    centroid_engine.set("average")
+
+    label = tk.Label(param_frame, text="Centroid:")
+    label.grid(row=4, column=0, sticky=tk.W)
+
+    optmenu = tk.OptionMenu(param_frame, centroid_engine,
+                            *pbt.TRACKER_ENGINES)
+    optmenu.grid(row=4, column=1, columnspan=2, sticky=tk.W)
+
     # an explanation of Minimum net brightness. Found it to be too long and
     # out of place in the GUI so have it commented out.
     '''
@@ -359,10 +1282,17 @@ if __name__ == "__main__":
     button_frame = tk.Frame(outer_frame)
     button_frame.grid(row=4, column=0, sticky=tk.W, pady=5)
 
-    button = tk.Button(button_frame, text="Start Analyzing",
-                       font=("Helvetica", 8, "bold"),
-                       command=lambda: analyze())
-    button.grid(row=0, column=0, sticky=tk.W)
+    start_button = tk.Button(button_frame, text="Start Analyzing",
+                             font=("Helvetica", 8, "bold"),
+                             command=lambda: analyze())
+    start_button.grid(row=0, column=0, sticky=tk.W)
+
+    # stops tracking; the frames tracked so far are still analyzed
+    cancel_event = threading.Event()
+    cancel_button = tk.Button(button_frame, text="Cancel",
+                              state=tk.DISABLED,
+                              command=lambda: cancel_event.set())
+    cancel_button.grid(row=0, column=1, sticky=tk.W, padx=5)
 
     # Interaction
     dialog_text = tk.StringVar()
@@ -13,11 +13,19 @@ Author: Donald Woodbry, University of Toronto
 '''
 
 from BeadTrackingToolsEdit1 import *
+from Trajectory import Trajectory
 from PIL import Image, ImageSequence, ImageDraw
 from numpy import average
+import numpy as np
 import pylab
 import os
+import json
+import struct
+import time
+import queue
+import threading
 import tkinter as tk
+from concurrent.futures import ProcessPoolExecutor
 
 def select_points(imag, threshold, file_type, box, colour = None):
     '''returns a list of (x,y) tuples containing the points
@@ -53,54 +61,1417 @@ def select_points(imag, threshold, file_type, box, colour = None):
     
     return points
 
+def clip_box(box, size):
+    '''returns the (x0, y0, x1, y1) bounds of box clipped to an image of the
+        given size, iterated over in the same way as select_points'''
+
+    return (max(box[0], 0), max(box[1], 0), \
+            min(box[2], size[0]), min(box[3], size[1]))
+
+def net_brightness(arr, file_type, colour = None):
+    '''returns an array of the values compared against the threshold in
+        select_points for each pixel of the image array arr, i.e. the
+        brightness for 8-bit images or the user selected colour channel minus
+        the average of the other two channels for RGB images. None is
+        returned if no colour channel is selected for an RGB image.'''
+
+    if file_type == '8-bit':
+        return arr.astype(np.float64)
+    elif file_type == 'RGB':
+        rgb = arr.astype(np.float64)
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        if colour == 'r':
+            return r - (g + b)/2
+        elif colour == 'g':
+            return g - (r + b)/2
+        elif colour == 'b':
+            return b - (g + r)/2
+    return None
+
+def frame_size(imag):
+    '''returns the (width, height) of a frame given either as a PIL image or
+        as an image array'''
+
+    if isinstance(imag, np.ndarray):
+        return (imag.shape[1], imag.shape[0])
+    return imag.size
+
+def box_array(imag, box):
+    '''returns the image array of the part of the frame imag inside the
+        clipped box, along with the (x0, y0) position of its top left corner.
+        imag may be a PIL image or an image array, in which case the box is
+        a view into it. None is returned for the array if the box is empty.'''
+
+    x0, y0, x1, y1 = clip_box(box, frame_size(imag))
+    if x1 <= x0 or y1 <= y0:
+        return None, x0, y0
+
+    if isinstance(imag, np.ndarray):
+        return imag[y0:y1, x0:x1], x0, y0
+    return np.asarray(imag.crop((x0, y0, x1, y1))), x0, y0
+
+def find_points(imag, threshold, file_type, box, colour = None):
+    '''vectorized version of select_points. Returns an (N, 2) integer array
+        of the (x, y) points in the box (box) of the image (imag) whose net
+        brightness exceeds the threshold, in the same order as select_points.
+        The box is converted to an array once rather than read pixel by
+        pixel. imag may be a PIL image or an image array.'''
+
+    arr, x0, y0 = box_array(imag, box)
+    if arr is None:
+        return np.zeros((0, 2), dtype=int)
+
+    d = net_brightness(arr, file_type, colour)
+    if d is None:
+        return np.zeros((0, 2), dtype=int)
+
+    # transposing the mask orders the points by x and then y, as the nested
+    # loops in select_points do
+    xs, ys = np.nonzero((d > threshold).T)
+
+    return np.column_stack((xs + x0, ys + y0))
+
+def find_centroid(imag, threshold, file_type, box, colour = None, \
+                  engine = 'average'):
+    '''returns the centre [x, y] of the spot in the box, or None if no
+        points exceed the threshold. engine names the centroid engine in
+        CENTROID_ENGINES used to locate the spot; the default 'average' is
+        equal to cluster_center(select_points(...)).'''
+
+    arr, x0, y0 = box_array(imag, box)
+    if arr is None:
+        return None
+    d = net_brightness(arr, file_type, colour)
+    if d is None:
+        return None
+
+    mask = d > threshold
+    if not mask.any():
+        return None
+
+    xc, yc = CENTROID_ENGINES[engine](d, mask, threshold, x0, y0)
+
+    return [xc, yc]
+
+# Centroid engines. Each takes the net brightness d of the search box, the
+# mask of the points above the threshold (at least one), the threshold and
+# the (x0, y0) position of the top left corner of the box, and returns the
+# (x, y) centre of the spot. The throughputs quoted are for a 25x25 px box
+# with a spot of radius 3 px, on one core, as measured by
+# centroid_throughput.
+
+def average_centroid(d, mask, threshold, x0 = 0, y0 = 0):
+    '''unweighted average of the coordinates of the points above the
+        threshold, as cluster_center. Positions are quantised by the
+        threshold. Throughput: about 50000 boxes/s.'''
+
+    ys, xs = np.nonzero(mask)
+
+    return (xs + x0).mean(), (ys + y0).mean()
+
+def weighted_centroid(d, mask, threshold, x0 = 0, y0 = 0):
+    '''average of the coordinates of the points above the threshold
+        weighted by their brightness above the threshold, which gives
+        sub-pixel positions that depend much less on the threshold.
+        Throughput: about 35000 boxes/s.'''
+
+    ys, xs = np.nonzero(mask)
+    w = d[ys, xs] - threshold
+    sw = np.sum(w)
+    if sw <= 0:
+        return average_centroid(d, mask, threshold, x0, y0)
+
+    return np.sum(w*xs)/sw + x0, np.sum(w*ys)/sw + y0
+
+def box_filter3(a):
+    '''returns the 3x3 moving average of the 2d array a, with zero padding
+        at the edges (as conv2(a, ones(3)/9, 'same'))'''
+
+    p = np.pad(a, 1)
+    s = p[:-2, :] + p[1:-1, :] + p[2:, :]
+
+    return (s[:, :-2] + s[:, 1:-1] + s[:, 2:]) / 9.0
+
+def radial_centroid(d, mask, threshold, x0 = 0, y0 = 0):
+    '''centre of radial symmetry of the whole box (Parthasarathy, Nature
+        Methods 9, 724 (2012)): the point closest, in the weighted least
+        squares sense, to the lines through each pixel corner along the
+        intensity gradient. Does not depend on the threshold and is close to
+        a Gaussian fit in accuracy. Throughput: about 4000 boxes/s.'''
+
+    ny, nx = d.shape
+    if nx < 3 or ny < 3:
+        return weighted_centroid(d, mask, threshold, x0, y0)
+
+    # coordinates of the pixel corners, relative to the centre of the box
+    xm = np.arange(nx - 1) - (nx - 2)/2.0
+    ym = np.arange(ny - 1)[:, None] - (ny - 2)/2.0
+    xm, ym = np.broadcast_arrays(xm, ym)
+
+    # gradients along the diagonals, smoothed
+    dIdu = d[:-1, 1:] - d[1:, :-1]
+    dIdv = d[:-1, :-1] - d[1:, 1:]
+    fdu = box_filter3(dIdu)
+    fdv = box_filter3(dIdv)
+    dImag2 = fdu*fdu + fdv*fdv
+    sdI2 = np.sum(dImag2)
+    if sdI2 == 0:
+        return weighted_centroid(d, mask, threshold, x0, y0)
+
+    # slopes of the gradient lines
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = -(fdv + fdu) / (fdu - fdv)
+        unsmoothed = (dIdv + dIdu) / (dIdu - dIdv)
+    m = np.where(np.isnan(m), unsmoothed, m)
+    m[np.isnan(m)] = 0
+    finite = np.isfinite(m)
+    if finite.any():
+        m[~finite] = 10*np.max(np.abs(m[finite]))
+    else:
+        m[:] = 0
+    b = ym - m*xm
+
+    # weight by gradient magnitude and inverse distance to the centroid
+    xcentroid = np.sum(dImag2*xm)/sdI2
+    ycentroid = np.sum(dImag2*ym)/sdI2
+    r = np.sqrt((xm - xcentroid)**2 + (ym - ycentroid)**2)
+    w = dImag2/np.maximum(r, 1e-12)
+
+    wm2p1 = w/(m*m + 1)
+    sw = np.sum(wm2p1)
+    smmw = np.sum(m*m*wm2p1)
+    smw = np.sum(m*wm2p1)
+    smbw = np.sum(m*b*wm2p1)
+    sbw = np.sum(b*wm2p1)
+    det = smw*smw - smmw*sw
+    if det == 0:
+        return weighted_centroid(d, mask, threshold, x0, y0)
+
+    xc = (smbw*sw - smw*sbw)/det
+    yc = (smbw*smw - smmw*sbw)/det
+
+    return xc + (nx - 1)/2.0 + x0, yc + (ny - 1)/2.0 + y0
+
+def gaussian_centroid(d, mask, threshold, x0 = 0, y0 = 0):
+    '''centre of a circular 2d Gaussian fitted by least squares to the
+        points above the threshold, after subtracting the median background
+        of the rest of the box. The fit is linearised (ln I is quadratic in
+        x and y) and weighted by I^2, so it is solved in closed form
+        (Guo, IEEE Signal Process. Mag. 28, 134 (2011)). Falls back to
+        weighted_centroid if the fit fails. Throughput: about 7000
+        boxes/s.'''
+
+    ys, xs = np.nonzero(mask)
+    if len(xs) < 4 or mask.all():
+        return weighted_centroid(d, mask, threshold, x0, y0)
+
+    I = d[ys, xs] - np.median(d[~mask])
+    keep = I > 0
+    if np.count_nonzero(keep) < 4:
+        return weighted_centroid(d, mask, threshold, x0, y0)
+    xs, ys, I = xs[keep], ys[keep], I[keep]
+
+    # weighted least squares for ln I = a + b x + c y + e (x^2 + y^2)
+    xr = xs - xs.mean()
+    yr = ys - ys.mean()
+    A = np.column_stack((np.ones(len(I)), xr, yr, xr*xr + yr*yr)) * I[:, None]
+    coef = np.linalg.lstsq(A, I*np.log(I), rcond=None)[0]
+    a, b, c, e = coef
+    if not e < 0:
+        return weighted_centroid(d, mask, threshold, x0, y0)
+
+    return xs.mean() - b/(2*e) + x0, ys.mean() - c/(2*e) + y0
+
+CENTROID_ENGINES = {
+    'average'  : average_centroid,
+    'weighted' : weighted_centroid,
+    'radial'   : radial_centroid,
+    'gaussian' : gaussian_centroid,
+}
+
+# the engines the trackers accept: the centroid engines, or 'template' for
+# a TemplateTracker
+TRACKER_ENGINES = sorted(CENTROID_ENGINES) + ['template']
+
+def centroid_throughput(engine, box_size = 25, spot_radius = 3.0, \
+                        threshold = 100, n = 2000):
+    '''returns the number of boxes per second the named centroid engine
+        locates a synthetic spot in, timed over n noisy boxes of box_size
+        pixels square'''
+
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:box_size, 0:box_size]
+    c = (box_size - 1)/2.0
+    boxes = []
+    for k in range(16):
+        cx, cy = c + rng.uniform(-1, 1, 2)
+        spot = 200*np.exp(-((xx - cx)**2 + (yy - cy)**2)/(2*spot_radius**2))
+        boxes.append(20 + spot + rng.normal(0, 3, spot.shape))
+
+    locate = CENTROID_ENGINES[engine]
+    t = time.perf_counter()
+    for k in range(n):
+        d = boxes[k % len(boxes)]
+        locate(d, d > threshold, threshold)
+
+    return n/(time.perf_counter() - t)
+
+class FrameSource(object):
+    '''The frames of a TIFF video. Frames of uncompressed, contiguously
+        stored pages are returned as zero-copy numpy.memmap views into the
+        file, so that only the bytes actually indexed (e.g. the search box)
+        are read from disk. Any other page is returned as a PIL image, as
+        ImageSequence.Iterator would.
+
+        im may be a file name or an open PIL image.'''
+
+    def __init__(self, im, memmap = True):
+        if isinstance(im, str):
+            im = Image.open(im)
+        self.im = im
+        self.size = im.size
+        self.filename = getattr(im, 'filename', None)
+
+        # byte offset of each page's pixel data, None if it must be decoded
+        # by PIL. Filled in as the pages are first visited.
+        self.offsets = {}
+
+        self.mm = None
+        if memmap and self.filename and os.path.isfile(self.filename) \
+           and im.format == 'TIFF' and im.mode in ('L', 'RGB'):
+            self.mm = np.memmap(self.filename, dtype=np.uint8, mode='r')
+            if im.mode == 'L':
+                self.shape = (self.size[1], self.size[0])
+            else:
+                self.shape = (self.size[1], self.size[0], 3)
+            self.nbytes = int(np.prod(self.shape))
+
+    def page_offset(self):
+        '''returns the offset of the pixel data of the page im is currently
+            on if it is stored uncompressed in one contiguous block, None
+            otherwise'''
+
+        if self.mm is None:
+            return None
+
+        row_bytes = self.nbytes // self.size[1]
+        offset = None
+        y = 0
+        for tile in self.im.tile:
+            codec, extents, tile_offset, args = tile
+            if codec != 'raw' or args[0] != self.im.mode \
+               or args[1] not in (0, row_bytes) or args[2] != 1 \
+               or extents != (0, y, self.size[0], extents[3]):
+                return None
+            if offset is None:
+                offset = tile_offset
+            elif tile_offset != offset + y*row_bytes:
+                return None
+            y = extents[3]
+
+        if offset is None or y != self.size[1] \
+           or offset + self.nbytes > len(self.mm):
+            return None
+        return offset
+
+    def frame(self, i):
+        '''returns frame i as an image array if it can be memory-mapped and
+            as a PIL image otherwise. Raises EOFError past the last frame.'''
+
+        if i not in self.offsets:
+            self.im.seek(i)
+            self.offsets[i] = self.page_offset()
+
+        offset = self.offsets[i]
+        if offset is None:
+            self.im.seek(i)
+            return self.im
+        return self.mm[offset:offset + self.nbytes].reshape(self.shape)
+
+    def frames(self, start_frame, stop_frame):
+        '''yields (i, frame) for the frames start_frame to stop_frame
+            (inclusive), like frame_range'''
+
+        i = max(start_frame, 0)
+        while i <= stop_frame:
+            try:
+                frame = self.frame(i)
+            except EOFError:
+                return
+            yield i, frame
+            i += 1
+
+    def image(self, i):
+        '''returns frame i as a PIL image'''
+
+        frame = self.frame(i)
+        if isinstance(frame, np.ndarray):
+            return Image.fromarray(np.array(frame))
+        return frame
+
+class PrefetchFrameSource(FrameSource):
+    '''A FrameSource whose frames are decoded ahead of the tracker by a pool
+        of background threads, each reading the file through its own
+        FrameSource (PIL releases the GIL while decoding). Frame i is decoded
+        by thread i % threads into a queue of at most depth frames, so no
+        more than threads*(depth + 1) decoded frames are held in memory at
+        once. frames() yields the frames as image arrays, in order;
+        uncompressed frames are memory-mapped views of the file, as from
+        FrameSource, rather than copies.'''
+
+    def __init__(self, filename, threads = 2, depth = 8, memmap = True):
+        FrameSource.__init__(self, filename, memmap)
+        self.threads = max(int(threads), 1)
+        self.depth = max(int(depth), 1)
+        self.memmap = memmap
+
+    def decode(self, first, stop_frame, out, stop):
+        '''decodes every self.threads'th frame from first to stop_frame into
+            the queue out until the end of the video or until stop is set'''
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            source = FrameSource(self.filename, self.memmap)
+            for i in range(first, stop_frame + 1, self.threads):
+                try:
+                    frame = source.frame(i)
+                except EOFError:
+                    break
+                if not isinstance(frame, np.ndarray):
+                    # decode PIL images here; memory-mapped frames are
+                    # passed on as views, read only when they are tracked
+                    frame = np.asarray(frame)
+                if not put(frame):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    def frames(self, start_frame, stop_frame):
+        '''yields (i, frame) for the frames start_frame to stop_frame
+            (inclusive), like FrameSource.frames'''
+
+        start_frame = max(start_frame, 0)
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.depth) for k in range(self.threads)]
+        workers = [threading.Thread(target=self.decode, \
+                                    args=(start_frame + k, stop_frame, \
+                                          queues[k], stop))
+                   for k in range(self.threads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            for i in range(start_frame, stop_frame + 1):
+                frame = queues[(i - start_frame) % self.threads].get()
+                if frame is None:
+                    return
+                if isinstance(frame, Exception):
+                    raise frame
+                yield i, frame
+        finally:
+            # also stops the workers if the tracker stops early
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+class TiffPage(object):
+    '''A read-only file object presenting the TIFF file fp (with byte order
+        order, '<' or '>') as if the page directory at offset ifd were its
+        first page, so that PIL opens that page directly instead of seeking
+        to it through the directories of all the pages before it.'''
+
+    def __init__(self, fp, ifd, order):
+        self.fp = fp
+        magic = b'II*\x00' if order == '<' else b'MM\x00*'
+        self.header = magic + struct.pack(order + 'I', ifd)
+        self.pos = 0
+
+    def read(self, n = -1):
+        data = b''
+        if self.pos < len(self.header):
+            data = self.header[self.pos:] if n < 0 else \
+                   self.header[self.pos:self.pos + n]
+            self.pos += len(data)
+            if n >= 0:
+                n -= len(data)
+                if n == 0:
+                    return data
+        self.fp.seek(self.pos)
+        more = self.fp.read() if n < 0 else self.fp.read(n)
+        self.pos += len(more)
+        return data + more
+
+    def seek(self, offset, whence = 0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += os.fstat(self.fp.fileno()).st_size
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def fileno(self):
+        # for libtiff, which is given the offset of the page directory
+        return self.fp.fileno()
+
+class WatchFrameSource(FrameSource):
+    '''The frames of a video that is still being recorded: either a TIFF
+        stack that is being appended to or a directory into which each
+        frame is written as its own TIFF file (taken in file name order).
+        frames() waits for each frame to be written, polling every poll
+        seconds, and ends once no new frame has appeared for timeout
+        seconds, so a tracker is never more than a poll interval behind the
+        camera.
+
+        A frame counts as written once a later frame exists or the file has
+        stopped growing for a poll interval. The pages of a growing stack
+        are found by following the chain of TIFF directories from the last
+        one seen, so finding a new page takes constant time however long
+        the stack is. Uncompressed pages are memory-mapped as by FrameSource;
+        other pages are decoded by PIL, opened directly at their directory
+        (see TiffPage), so that reading a page also takes constant time.
+        New files in a directory are found by comparing its listing with
+        the files already seen.'''
+
+    # TIFF tags read from each page directory
+    TAGS = {256: 'width', 257: 'height', 258: 'bits', 259: 'compression', \
+            273: 'offsets', 277: 'samples', 279: 'counts', 284: 'planar'}
+
+    def __init__(self, path, poll = 0.05, timeout = 10.0, memmap = True):
+        self.path = path
+        self.filename = path
+        self.poll = poll
+        self.timeout = timeout
+        self.memmap = memmap
+        self.directory = os.path.isdir(path)
+        self.im = None
+        self.mm = None
+        self.size = None
+        self.files = [] # directory: the frame files found so far
+        self.seen = set() # directory: the same, as a set
+        self.offsets = [] # stack: pixel data offset of each page found
+        self.ifds = [] # stack: directory offset of each page found
+        self.fp = None
+        self.order = None # byte order of the stack
+        self.next_at = None # position of the next page pointer to follow
+        self.length = -1 # size of the file (stack) or last file (directory)
+        self.changed = time.time() # when the size last changed
+        self.growing = True # if the size changed within the last poll
+
+    def settle(self, length):
+        '''records the current size of the file being written and whether
+            it has changed within the last poll interval'''
+
+        now = time.time()
+        if length != self.length:
+            self.length = length
+            self.changed = now
+        self.growing = now - self.changed < self.poll
+
+    def scan(self):
+        '''looks for new frames and returns the number of frames found so
+            far'''
+
+        if self.directory:
+            # frames are written in file name order, so new files sort
+            # after those already seen
+            new = sorted(f for f in os.listdir(self.path) \
+                         if f not in self.seen \
+                         and f.lower().endswith(('.tif', '.tiff')))
+            if new:
+                self.files.extend(new)
+                self.seen.update(new)
+                self.length = -1
+            if self.files:
+                self.settle(os.path.getsize(os.path.join(self.path, \
+                                                         self.files[-1])))
+            return len(self.files)
+
+        if not os.path.isfile(self.path):
+            return 0
+        self.settle(os.path.getsize(self.path))
+        if self.fp is None:
+            # unbuffered, so that bytes rewritten by the camera are seen
+            self.fp = open(self.path, 'rb', buffering=0)
+        if self.order is None:
+            header = self.read(0, 8)
+            if header is None:
+                return 0
+            self.order = {b'II': '<', b'MM': '>'}.get(header[:2])
+            if self.order is None or \
+               struct.unpack(self.order + 'H', header[2:4])[0] != 42:
+                raise ValueError('%s is not a (non-BigTIFF) TIFF file' \
+                                 % self.path)
+            self.next_at = 4
+
+        # follow the chain of page directories
+        while True:
+            data = self.read(self.next_at, 4)
+            ifd = struct.unpack(self.order + 'I', data)[0] if data else 0
+            if ifd == 0:
+                break
+            page = self.read_ifd(ifd)
+            if page is None:
+                break # the directory is still being written
+            tags, next_at = page
+            self.ifds.append(ifd)
+            self.offsets.append(self.page_data(tags))
+            self.next_at = next_at
+
+        return len(self.offsets)
+
+    def read(self, offset, n):
+        '''returns n bytes of the stack at offset, None if they have not
+            all been written'''
+
+        if offset + n > self.length:
+            return None
+        self.fp.seek(offset)
+        data = self.fp.read(n)
+        return data if len(data) == n else None
+
+    def read_ifd(self, ifd):
+        '''returns the tags of the page directory at offset ifd that are
+            in TAGS and the position of its next page pointer, or None if
+            the directory has not all been written'''
+
+        data = self.read(ifd, 2)
+        if data is None:
+            return None
+        n = struct.unpack(self.order + 'H', data)[0]
+        data = self.read(ifd + 2, 12*n + 4)
+        if data is None:
+            return None
+
+        tags = {}
+        for k in range(n):
+            tag, typ, count, value = struct.unpack(self.order + 'HHI4s', \
+                                                   data[12*k:12*k + 12])
+            if tag not in self.TAGS or typ not in (3, 4):
+                continue
+            fmt = 'H' if typ == 3 else 'I'
+            size = count * (2 if typ == 3 else 4)
+            if size > 4:
+                value = self.read(struct.unpack(self.order + 'I', value)[0], \
+                                  size)
+                if value is None:
+                    return None
+            tags[self.TAGS[tag]] = struct.unpack(self.order + fmt*count, \
+                                                 value[:size])
+        return tags, ifd + 2 + 12*n
+
+    def page_data(self, tags):
+        '''returns the offset of the pixel data of a page with the given
+            tags if it is stored uncompressed and contiguously in the same
+            format as the first page, None otherwise'''
+
+        try:
+            width, height = tags['width'][0], tags['height'][0]
+            samples = tags.get('samples', (1,))[0]
+            offsets, counts = tags['offsets'], tags['counts']
+        except KeyError:
+            return None
+        if self.size is None:
+            self.size = (width, height)
+            if samples == 1:
+                self.shape = (height, width)
+            else:
+                self.shape = (height, width, samples)
+            self.nbytes = width * height * samples
+
+        if (width, height) != self.size or samples not in (1, 3) \
+           or self.shape[2:] not in ((), (samples,)) \
+           or tags.get('compression', (1,))[0] != 1 \
+           or set(tags.get('bits', (8,))) != set([8]) \
+           or tags.get('planar', (1,))[0] != 1 \
+           or sum(counts) != self.nbytes:
+            return None
+        for k in range(1, len(offsets)):
+            if offsets[k] != offsets[k - 1] + counts[k - 1]:
+                return None
+        return offsets[0]
+
+    def ready(self, i):
+        '''returns True if frame i has been completely written'''
+
+        n = len(self.files) if self.directory else len(self.offsets)
+        if i >= n - 1 or not self.directory and self.offsets[i] is not None \
+           and self.offsets[i] + self.nbytes > self.length:
+            # only look for new frames when they are needed
+            n = self.scan()
+        if i >= n or i == n - 1 and self.growing:
+            return False
+        if self.directory or self.offsets[i] is None:
+            return True
+        return self.offsets[i] + self.nbytes <= self.length
+
+    def frame(self, i):
+        '''returns frame i as an image array if it can be memory-mapped and
+            as a PIL image otherwise. Raises EOFError if it has not been
+            written yet.'''
+
+        if not self.ready(i):
+            raise EOFError('frame %d has not been written yet' % i)
+
+        if self.directory:
+            with Image.open(os.path.join(self.path, self.files[i])) as im:
+                if self.memmap:
+                    return np.asarray(im)
+                im.load()
+                return im.copy()
+
+        offset = self.offsets[i]
+        if offset is None or not self.memmap:
+            im = Image.open(TiffPage(self.fp, self.ifds[i], self.order))
+            im.load()
+            return im
+        if self.mm is None or len(self.mm) < offset + self.nbytes:
+            # map the file again as it grows
+            self.mm = np.memmap(self.path, dtype=np.uint8, mode='r')
+        return self.mm[offset:offset + self.nbytes].reshape(self.shape)
+
+    def wait_frame(self, i):
+        '''returns frame i once it has been written. Raises EOFError if no
+            new frame has been written for timeout seconds.'''
+
+        last = time.time()
+        n = self.scan()
+        while True:
+            try:
+                return self.frame(i)
+            except EOFError:
+                pass
+            found = self.scan()
+            if found > n or self.growing:
+                n = found
+                last = time.time()
+            elif time.time() - last > self.timeout:
+                raise EOFError('no new frame written in %g s' % self.timeout)
+            time.sleep(self.poll)
+
+    def frames(self, start_frame, stop_frame):
+        '''yields (i, frame) for the frames start_frame to stop_frame
+            (inclusive) as they are written, like FrameSource.frames'''
+
+        i = max(start_frame, 0)
+        while i <= stop_frame:
+            try:
+                frame = self.wait_frame(i)
+            except EOFError:
+                return
+            yield i, frame
+            i += 1
+
+class SpotTracker(object):
+    '''Follows a single spot from frame to frame. The spot is searched for in
+        a box of half-width max_pix + spot_size around its last centroid; if
+        no points are found, the centroid is kept as in the previous frame
+        and the frame counts as lost. engine names the centroid engine (see
+        CENTROID_ENGINES) used to locate the spot in the box.'''
+
+    def __init__(self, first_spot, max_pix, spot_size, spot_brightness, \
+                 file_type, colour = None, engine = 'average'):
+        self.centroid = first_spot # default location of the spot
+        self.max_pix = max_pix
+        self.spot_size = spot_size
+        self.spot_brightness = spot_brightness
+        self.file_type = file_type
+        self.colour = colour
+        self.engine = engine
+        self.lost = 0 # number of sequential frames with no spot found
+        self.recovered = False # if a lost spot was found in the last frame
+
+    # the attributes that change from frame to frame, saved in checkpoints
+    STATE = ('centroid', 'lost', 'recovered')
+
+    def state(self):
+        '''returns a dictionary of arrays of the tracker's state (STATE
+            attributes that are not None)'''
+
+        return dict((name, np.asarray(getattr(self, name))) \
+                    for name in self.STATE if getattr(self, name) is not None)
+
+    def set_state(self, state):
+        '''restores the tracker's state from a dictionary returned by
+            state'''
+
+        for name in self.STATE:
+            if name in state:
+                value = np.asarray(state[name])
+                setattr(self, name, value.tolist() if value.ndim == 1 \
+                        and name in ('centroid', 'offset') else \
+                        value.item() if value.ndim == 0 else value)
+
+    def box(self):
+        '''returns the box in which to search for the spot in the next
+            frame'''
+
+        d_box = self.max_pix + self.spot_size # defines the size of the box
+                                              # in which the program will
+                                              # search for the spot
+
+        return [int(self.centroid[0]) - d_box, int(self.centroid[1]) - d_box, \
+                int(self.centroid[0]) + d_box, int(self.centroid[1]) + d_box]
+
+    def update(self, frame):
+        '''locates the spot in the next frame and returns True if it was
+            found. The centroid is then available as self.centroid.'''
+
+        #collecting the coloured points contained inside the given
+        #box inside a given frame and defining their centroid
+
+        found = find_centroid(frame, self.spot_brightness, self.file_type, \
+                              self.box(), self.colour, self.engine)
+        if found is None:
+            self.lost += 1
+            self.recovered = False
+            return False
+        self.centroid = found
+        self.recovered = self.lost > 0
+        self.lost = 0
+        return True
+
+class PredictiveTracker(SpotTracker):
+    '''A SpotTracker that predicts the next position of the spot with a
+        constant-velocity (alpha-beta) filter and searches a box fitted
+        tightly around the prediction, of half-width spot_size plus three
+        times the RMS prediction error (at most max_pix). After each
+        consecutive frame in which the spot is not found, the box is doubled
+        in size, and once it covers the frame, or after coarse_after misses,
+        the whole frame is searched with seed_spot for the spot nearest the
+        prediction. self.recovered is True after a frame in which a lost
+        spot was found again.
+
+        The reported centroids are the measured ones; the filter is only
+        used to place the search box.'''
+
+    def __init__(self, first_spot, max_pix, spot_size, spot_brightness, \
+                 file_type, colour = None, engine = 'average', alpha = 0.85, \
+                 beta = 0.1, coarse_after = 4):
+        SpotTracker.__init__(self, first_spot, max_pix, spot_size, \
+                             spot_brightness, file_type, colour, engine)
+        self.alpha = alpha
+        self.beta = beta
+        self.coarse_after = coarse_after
+        self.position = np.array(first_spot, dtype=float)
+        self.velocity = np.zeros(2)
+        self.rms = None # RMS prediction error, None until first measured
+
+    STATE = SpotTracker.STATE + ('position', 'velocity', 'rms')
+
+    def predict(self):
+        '''returns the predicted (x, y) position of the spot in the next
+            frame'''
+
+        return self.position + self.velocity
+
+    def half_width(self):
+        '''returns the half-width of the next search box'''
+
+        if self.lost > 0:
+            return (self.max_pix + self.spot_size) * 2**self.lost
+        if self.rms is None:
+            return self.max_pix + self.spot_size
+        margin = min(max(int(np.ceil(3*self.rms)), 1), self.max_pix)
+        return self.spot_size + margin
+
+    def box(self):
+        '''returns the box in which to search for the spot in the next
+            frame'''
+
+        p = self.predict()
+        d_box = self.half_width()
+
+        return [int(p[0]) - d_box, int(p[1]) - d_box, \
+                int(p[0]) + d_box, int(p[1]) + d_box]
+
+    def update(self, frame):
+        '''locates the spot in the next frame and returns True if it was
+            found. The centroid is then available as self.centroid.'''
+
+        p = self.predict()
+        if self.lost >= self.coarse_after or \
+           self.half_width() >= max(frame_size(frame)):
+            found = seed_spot(frame, self.spot_brightness, self.file_type, \
+                              self.spot_size, p, self.colour, self.engine)
+        else:
+            found = find_centroid(frame, self.spot_brightness, \
+                                  self.file_type, self.box(), self.colour, \
+                                  self.engine)
+
+        if found is None:
+            # coast on the prediction, slowing down while the spot is lost
+            self.position = p
+            self.velocity = self.velocity / 2
+            self.lost += 1
+            self.recovered = False
+            return False
+
+        r = np.array(found, dtype=float) - p
+        e2 = np.dot(r, r)
+        if self.rms is None:
+            self.rms = np.sqrt(e2)
+        else:
+            self.rms = np.sqrt(0.9*self.rms**2 + 0.1*e2)
+        self.position = p + self.alpha*r
+        self.velocity = self.velocity + self.beta*r
+
+        self.centroid = found
+        self.recovered = self.lost > 0
+        self.lost = 0
+        return True
+
+class TemplateTracker(SpotTracker):
+    '''Follows a spot by FFT cross-correlation with a template of the spot
+        instead of thresholding each frame, which is more robust for dim or
+        low-contrast spots and uneven illumination. The template is the
+        (2*spot_size + 1) px square of net brightness around the spot in
+        the first frame, whose centroid (found by thresholding) defines the
+        reference point. Its Fourier transform, zero-padded to the size of
+        the search box, is computed once and reused in every frame. The
+        correlation peak is located to sub-pixel precision by parabolic
+        interpolation. A frame counts as lost if the peak is below
+        min_peak times the template's correlation with itself.'''
+
+    def __init__(self, first_spot, max_pix, spot_size, spot_brightness, \
+                 file_type, colour = None, min_peak = 0.2):
+        SpotTracker.__init__(self, first_spot, max_pix, spot_size, \
+                             spot_brightness, file_type, colour)
+        self.min_peak = min_peak
+        # set by make_template once the spot has been found
+        self.template_fft = None
+        self.autocorrelation = None
+        self.size = None
+        self.n_shifts = None
+        self.offset = None
+
+    STATE = SpotTracker.STATE + ('template_fft', 'autocorrelation', 'size', \
+                                 'n_shifts', 'offset')
+
+    def make_template(self, frame):
+        '''builds the template from the spot around self.centroid in frame,
+            returning False if the spot is not found there'''
+
+        found = find_centroid(frame, self.spot_brightness, self.file_type, \
+                              SpotTracker.box(self), self.colour)
+        if found is None:
+            return False
+        self.centroid = found
+
+        r = int(self.spot_size)
+        cx, cy = int(found[0]), int(found[1])
+        arr, x0, y0 = box_array(frame, [cx - r, cy - r, cx + r + 1, cy + r + 1])
+        if arr is None or arr.shape[:2] != (2*r + 1, 2*r + 1):
+            return False
+        t = net_brightness(arr, self.file_type, self.colour)
+        if t is None:
+            return False
+        t = t - t.mean()
+
+        # the search box is 2*d_box px square
+        self.size = 2*(self.max_pix + self.spot_size)
+        self.template_fft = np.conj(np.fft.rfft2(t, s=(self.size, self.size)))
+        self.autocorrelation = np.sum(t*t)
+        self.n_shifts = self.size - (2*r + 1) + 1 # valid template positions
+        # position of the spot centre relative to the template's corner
+        self.offset = (found[0] - x0, found[1] - y0)
+        return True
+
+    def update(self, frame):
+        '''locates the spot in the next frame and returns True if it was
+            found. The centroid is then available as self.centroid.'''
+
+        if self.template_fft is None:
+            if not self.make_template(frame):
+                self.lost += 1
+                self.recovered = False
+                return False
+            self.recovered = self.lost > 0
+            self.lost = 0
+            return True
+
+        box = self.box()
+        arr, x0, y0 = box_array(frame, box)
+        if arr is None or self.n_shifts < 1 or self.autocorrelation <= 0:
+            return self.miss()
+        d = net_brightness(arr, self.file_type, self.colour)
+        if d is None:
+            return self.miss()
+
+        # pad a box clipped by the edge of the frame to the full size with
+        # its mean, keeping track of where the box starts
+        mean = d.mean()
+        roi = np.full((self.size, self.size), mean)
+        ox, oy = x0 - box[0], y0 - box[1]
+        roi[oy:oy + d.shape[0], ox:ox + d.shape[1]] = d[:self.size - oy, \
+                                                        :self.size - ox]
+        roi -= mean
+
+        corr = np.fft.irfft2(np.fft.rfft2(roi) * self.template_fft, \
+                             s=(self.size, self.size))
+        corr = corr[:self.n_shifts, :self.n_shifts]
+        sy, sx = np.unravel_index(np.argmax(corr), corr.shape)
+        peak = corr[sy, sx]
+        if peak < self.min_peak*self.autocorrelation:
+            return self.miss()
+
+        def refine(c_minus, c_0, c_plus):
+            # vertex of the parabola through three neighbouring values
+            denom = c_minus - 2*c_0 + c_plus
+            if denom >= 0:
+                return 0.0
+            return 0.5*(c_minus - c_plus)/denom
+
+        dx = dy = 0.0
+        if 0 < sx < self.n_shifts - 1:
+            dx = refine(corr[sy, sx - 1], peak, corr[sy, sx + 1])
+        if 0 < sy < self.n_shifts - 1:
+            dy = refine(corr[sy - 1, sx], peak, corr[sy + 1, sx])
+
+        self.centroid = [box[0] + sx + dx + self.offset[0], \
+                         box[1] + sy + dy + self.offset[1]]
+        self.recovered = self.lost > 0
+        self.lost = 0
+        return True
+
+    def miss(self):
+        '''records a frame in which the spot was not found'''
+
+        self.lost += 1
+        self.recovered = False
+        return False
+
+def make_tracker(first_spot, max_pix, spot_size, spot_brightness, \
+                 file_type, predict = False, engine = 'average'):
+    '''returns a TemplateTracker if engine is 'template', otherwise a
+        PredictiveTracker if predict is True and a SpotTracker if not, using
+        the named centroid engine'''
+
+    if engine == 'template':
+        return TemplateTracker(first_spot, max_pix, spot_size, \
+                               spot_brightness, file_type)
+    if predict:
+        return PredictiveTracker(first_spot, max_pix, spot_size, \
+                                 spot_brightness, file_type, engine=engine)
+    return SpotTracker(first_spot, max_pix, spot_size, spot_brightness, \
+                       file_type, engine=engine)
+
+def save_checkpoint(path, spot_track, frame, tracker, recovered = None):
+    '''saves the centroids spot_track found up to and including frame,
+        their metadata (the tracking parameters), the state of tracker and
+        the list of recovered frames to the .npz file path. The file is
+        replaced atomically, so an interruption leaves the previous
+        checkpoint intact.'''
+
+    arrays = dict(('tracker_' + name, value) \
+                  for name, value in tracker.state().items())
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, spot_track = spot_track.xy, frames = spot_track.frames, \
+                 found = spot_track.found, frame = frame, \
+                 tracker = type(tracker).__name__, \
+                 metadata = json.dumps(spot_track.metadata, sort_keys=True), \
+                 recovered = np.array(recovered or [], dtype=int), **arrays)
+    os.replace(tmp, path)
+
+def load_checkpoint(path, tracker, metadata = None):
+    '''restores the state of tracker from the checkpoint file path and
+        returns the Trajectory of the centroids found so far, the last frame
+        they cover and the list of recovered frames. Raises ValueError,
+        leaving tracker unchanged, if the checkpoint is of another kind of
+        tracker or, if metadata is given, was made with other tracking
+        parameters.'''
+
+    with np.load(path) as data:
+        if str(data['tracker']) != type(tracker).__name__:
+            raise ValueError('%s is a checkpoint of a %s, not a %s' % \
+                             (path, data['tracker'], type(tracker).__name__))
+        saved = json.loads(str(data['metadata'])) \
+                if 'metadata' in data.files else None
+        if metadata is not None and \
+           saved != json.loads(json.dumps(metadata)):
+            raise ValueError('%s was made with different tracking parameters'\
+                             ' (%s)' % (path, saved))
+        tracker.set_state(dict((name[len('tracker_'):], data[name]) \
+                               for name in data.files \
+                               if name.startswith('tracker_')))
+        spot_track = Trajectory.from_arrays(data['spot_track'], \
+                                            data['frames'], data['found'], \
+                                            saved)
+        return spot_track, int(data['frame']), data['recovered'].tolist()
+
 def track_spot(im, first_spot, max_pix, spot_size, spot_brightness, \
-               start_frame, stop_frame, file_type):
-    '''returns a list of (x,y) tuples containing the centroids of the spots
-        located in each frame.
+               start_frame, stop_frame, file_type, predict = False, \
+               recovered = None, engine = 'average', stats = None, \
+               checkpoint = None, checkpoint_interval = 30.0, resume = False, \
+               progress = None, cancel = None):
+    '''returns a Trajectory of the (x, y) centroids of the spot located in
+        each frame, with the tracking parameters as its metadata.
 
         max_pix defines the furthest distance the spot may travel between frames
         and colour defines the colour of the particle to be tracked
+
+        If predict is True, a PredictiveTracker is used to search for the
+        spot around its predicted position and to recover it once lost. If
+        recovered is a list, the frames in which a lost spot was found again
+        are appended to it. engine names the centroid engine used to locate
+        the spot in each frame (see CENTROID_ENGINES), or is 'template' to
+        follow the spot by cross-correlation with a TemplateTracker.
+
+        If stats is given, e.g. a TrapAnalysis.RunningStiffness, each
+        centroid is passed to stats.add(x, y) as it is found, and tracking
+        stops early, returning a shorter list, once stats.add returns True.
+
+        If checkpoint is a file name, the centroids found so far and the
+        tracker's state are saved to it every checkpoint_interval seconds
+        and if tracking is interrupted (see save_checkpoint); it is deleted
+        once tracking is complete. If resume is True and the checkpoint
+        exists, tracking continues from the frame after the checkpoint,
+        provided it was made with the same parameters; otherwise tracking
+        starts again from start_frame.
+
+        progress, if given, is called with the number of each frame once it
+        has been tracked. cancel may be a threading.Event: once it is set,
+        tracking stops after the current frame and the centroids found so
+        far are returned (and checkpointed, so that tracking can be
+        resumed).
     '''
 
     #iterating over the fames in the image sequence to find the
     #coloured pixels in each frame and their centroid
 
-    spot_track = []
-    
-    i = 0 # frame counter
-    j = 2 # counter for sequential frames with no spots found (starting at two)
+    metadata = {'start_frame': start_frame, 'stop_frame': stop_frame, \
+                'first_spot': [float(c) for c in first_spot], \
+                'max_pix': max_pix, 'spot_size': spot_size, \
+                'spot_brightness': spot_brightness, 'file_type': file_type, \
+                'predict': bool(predict), 'engine': engine}
+    # room for every frame, up to 2^16 to begin with
+    spot_track = Trajectory(min(stop_frame - max(start_frame, 0) + 1, 2**16), \
+                            metadata)
 
-    #default location of the spot
-    centroid = first_spot
+    tracker = make_tracker(first_spot, max_pix, spot_size, spot_brightness, \
+                           file_type, predict, engine)
 
-    for frame in ImageSequence.Iterator(im):
-        
-        d_box = max_pix + spot_size # defines the size of the box in which
-                                    # the program will search for the spot
+    if not isinstance(im, FrameSource):
+        im = FrameSource(im)
 
-        #initializing the box to search
-            
-        box = [int(centroid[0]) - d_box, int(centroid[1]) - d_box, \
-               int(centroid[0]) + d_box, int(centroid[1]) + d_box]
-
-        # this if statement limits the analysis to only
-        # the frames [start_frame, stop_frame) 
-        if start_frame -1< i < stop_frame+1:
-            #collecting the coloured points contained inside the given
-            #box inside a given frame and defining their centroid
-            
-            points = select_points(frame, spot_brightness, file_type, box)
-            if points == []:        #if no points are found, the centroid is
-                d_box = d_box*j     #defined as in the previous frame and the
-                                    #box is expanded by a factor of j
+    first = start_frame
+    loaded = None
+    if resume and checkpoint is not None and os.path.isfile(checkpoint):
+        try:
+            loaded = load_checkpoint(checkpoint, tracker, metadata)
+        except ValueError as e:
+            print ('Not resuming: %s' % e)
+    if loaded is not None:
+        spot_track, last, found_again = loaded
+        if recovered is not None:
+            recovered.extend(found_again)
+        if stats is not None:
+            for k, centroid in enumerate(spot_track):
+                if stats.add(*centroid):
+                    return spot_track[:k + 1]
+        first = last + 1
+        print ('Resuming from frame %d' % first)
+
+    # only the frames [start_frame, stop_frame] are read from the sequence
+    i = first - 1
+    saved = time.time()
+    try:
+        for i, frame in im.frames(first, stop_frame):
+            found = tracker.update(frame)
+            if not found:
+                # the centroid is defined as in the previous frame
                 print ('Cannot find spot in frame %d' % i)
+            elif tracker.recovered and recovered is not None:
+                recovered.append(i)
+            spot_track.append(tracker.centroid, i, found)
+            if progress is not None:
+                progress(i)
+            if stats is not None and stats.add(*tracker.centroid):
+                print ('Stiffness converged at frame %d' % i)
+                break
+            if cancel is not None and cancel.is_set():
+                print ('Tracking cancelled at frame %d' % i)
+                if checkpoint is not None:
+                    save_checkpoint(checkpoint, spot_track, i, tracker, \
+                                    recovered)
+                return spot_track
+            if checkpoint is not None and \
+               time.time() - saved >= checkpoint_interval:
+                save_checkpoint(checkpoint, spot_track, i, tracker, recovered)
+                saved = time.time()
+    except BaseException:
+        if checkpoint is not None and spot_track:
+            # the centroids of frame i are already in spot_track if it was
+            # completed
+            done = len(spot_track) == i - max(start_frame, 0) + 1
+            last = i if done else i - 1
+            save_checkpoint(checkpoint, spot_track, last, tracker, recovered)
+        raise
+
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        os.remove(checkpoint)
+    return spot_track
+
+def track_spots(im, first_spots, max_pix, spot_size, spot_brightness, \
+                start_frame, stop_frame, file_type, predict = False, \
+                engine = 'average'):
+    '''tracks several spots, starting from the list of locations first_spots,
+        in a single pass over the frames. Each spot has its own SpotTracker
+        (a PredictiveTracker if predict is True), i.e. its own search box and
+        lost frame count, using the named centroid engine. Returns an
+        (N, frames, 2) array of the (x, y) centroids of the N spots in each
+        frame.'''
+
+    trackers = [make_tracker(spot, max_pix, spot_size, spot_brightness, \
+                             file_type, predict, engine) \
+                for spot in first_spots]
+
+    if not isinstance(im, FrameSource):
+        im = FrameSource(im)
+
+    n = max(stop_frame - max(start_frame, 0) + 1, 0)
+    tracks = np.zeros((len(trackers), n, 2))
+    k = 0
+    for i, frame in im.frames(start_frame, stop_frame):
+        for b, tracker in enumerate(trackers):
+            if not tracker.update(frame):
+                print ('Cannot find spot %d in frame %d' % (b, i))
+            tracks[b, k] = tracker.centroid
+        k += 1
+
+    return tracks[:, :k]
+
+def label_regions(mask):
+    '''returns an integer array of the same shape as the boolean array mask
+        in which the pixels of each 4-connected region of True pixels share
+        a label from 1 to the number of regions, and all other pixels are 0,
+        along with the number of regions. The labels are found by vectorized
+        minimum-label propagation with pointer jumping.'''
+
+    h, w = mask.shape
+    idx = np.flatnonzero(mask)
+    if len(idx) == 0:
+        return np.zeros(mask.shape, dtype=int), 0
+
+    # each pixel starts labelled with its own flat index, background pixels
+    # with a value larger than any index
+    big = mask.size
+    lab = np.full(mask.size, big, dtype=np.int64)
+    lab[idx] = idx
+    lab = lab.reshape(h, w)
+
+    while True:
+        new = lab.copy()
+        np.minimum(new[1:, :], lab[:-1, :], out=new[1:, :])
+        np.minimum(new[:-1, :], lab[1:, :], out=new[:-1, :])
+        np.minimum(new[:, 1:], lab[:, :-1], out=new[:, 1:])
+        np.minimum(new[:, :-1], lab[:, 1:], out=new[:, :-1])
+        new[~mask] = big
+
+        # pointer jumping: take on the label of the pixel labelled by
+        flat = new.reshape(-1)
+        flat[idx] = flat[flat[idx]]
+
+        if np.array_equal(new, lab):
+            break
+        lab = new
+
+    regions, inverse = np.unique(lab.reshape(-1)[idx], return_inverse=True)
+    labels = np.zeros(mask.size, dtype=int)
+    labels[idx] = inverse + 1
+
+    return labels.reshape(h, w), len(regions)
+
+def detect_beads(imag, threshold, file_type, spot_size, colour = None, \
+                 min_area = None, max_area = None):
+    '''returns a list of the [x, y] centroids of the candidate beads in the
+        frame imag, brightest first. Pixels whose net brightness exceeds the
+        threshold are grouped into connected regions, and regions whose
+        area (pixels) is outside [min_area, max_area] are rejected. By
+        default the area must lie between that of a disc of radius
+        spot_size/3 and one of radius 2*spot_size. The candidates are ranked
+        by their total brightness above the threshold.'''
+
+    w, h = frame_size(imag)
+    arr, x0, y0 = box_array(imag, (0, 0, w, h))
+    if arr is None:
+        return []
+    d = net_brightness(arr, file_type, colour)
+    if d is None:
+        return []
+
+    if min_area is None:
+        min_area = np.pi*(spot_size/3.0)**2
+    if max_area is None:
+        max_area = np.pi*(2.0*spot_size)**2
+
+    mask = d > threshold
+    labels, n = label_regions(mask)
+    if n == 0:
+        return []
+
+    ys, xs = np.nonzero(mask)
+    lab = labels[ys, xs]
+    area = np.bincount(lab, minlength=n + 1)[1:]
+    xsum = np.bincount(lab, weights=xs, minlength=n + 1)[1:]
+    ysum = np.bincount(lab, weights=ys, minlength=n + 1)[1:]
+    brightness = np.bincount(lab, weights=d[ys, xs] - threshold, \
+                             minlength=n + 1)[1:]
+
+    keep = np.flatnonzero((area >= min_area) & (area <= max_area))
+    keep = keep[np.argsort(-brightness[keep], kind='stable')]
+
+    return [[xsum[k]/area[k] + x0, ysum[k]/area[k] + y0] for k in keep]
+
+def seed_spot(imag, threshold, file_type, spot_size, near, colour = None, \
+              engine = 'average'):
+    '''coarse full-frame detection of the spot in the frame imag. The
+        thresholded frame is downsampled into blocks of spot_size pixels and
+        the centroid (found by the named engine) of the points around the
+        bright block nearest to the point near is returned, or None if no
+        points are found.'''
+
+    w, h = frame_size(imag)
+    arr, x0, y0 = box_array(imag, (0, 0, w, h))
+    if arr is None:
+        return None
+    d = net_brightness(arr, file_type, colour)
+    if d is None:
+        return None
+
+    b = max(int(spot_size), 1)
+    mask = d[:h//b*b, :w//b*b] > threshold
+    blocks = mask.reshape(h//b, b, w//b, b).any(axis=3).any(axis=1)
+    by, bx = np.nonzero(blocks)
+    if len(bx) == 0:
+        return None
+
+    # centres of the bright blocks, in pixels
+    cx = bx*b + b/2
+    cy = by*b + b/2
+    k = np.argmin((cx - near[0])**2 + (cy - near[1])**2)
+
+    d_box = 2*b
+    box = [int(cx[k]) - d_box, int(cy[k]) - d_box, \
+           int(cx[k]) + d_box, int(cy[k]) + d_box]
+    return find_centroid(imag, threshold, file_type, box, colour, engine)
+
+def track_chunk(filename, first_spot, max_pix, spot_size, spot_brightness, \
+                start_frame, stop_frame, file_type, seed = True, \
+                predict = False, engine = 'average'):
+    '''tracks the spot in the frames [start_frame, stop_frame] of the video
+        filename. If seed is True the spot is first located by seed_spot in
+        start_frame, searching near first_spot. Returns the Trajectory and
+        the list of frames recovered by a predictive tracker; both are empty
+        if the video ends before start_frame. Used by track_spot_parallel
+        to track each chunk in a separate process.'''
+
+    im = FrameSource(filename)
+    try:
+        first_frame = im.frame(start_frame)
+    except EOFError:
+        return Trajectory(), []
+    if seed:
+        found = seed_spot(first_frame, spot_brightness, file_type, \
+                          spot_size, first_spot)
+        if found is not None:
+            first_spot = found
+
+    recovered = []
+    spot_track = track_spot(im, first_spot, max_pix, spot_size, \
+                            spot_brightness, start_frame, stop_frame, \
+                            file_type, predict, recovered, engine)
+    return spot_track, recovered
+
+def track_spot_parallel(filename, first_spot, max_pix, spot_size, \
+                        spot_brightness, start_frame, stop_frame, file_type, \
+                        predict = False, recovered = None, \
+                        engine = 'average', n_chunks = None, overlap = 10, \
+                        max_workers = None):
+    '''returns the same Trajectory of centroids as track_spot for the video
+        filename, tracking the frame range in n_chunks chunks (one per core
+        by default) in separate processes. If recovered is a list, the
+        frames recovered by a predictive tracker are appended to it.
+
+        Each chunk after the first starts overlap frames before its range and
+        is seeded by a coarse detection of the spot (seed_spot) in its first
+        frame. When the chunks are stitched together, the centroid of the
+        last overlapping frame must agree with the previous chunk, after
+        which the sequential result is determined. A chunk that does not
+        agree is tracked again sequentially from the end of the previous
+        chunk.
+
+        That holds for the default SpotTracker, whose state is just its
+        centroid. A PredictiveTracker (predict) also carries a velocity from
+        frame to frame, so the stitched result may then differ slightly from
+        track_spot's. A TemplateTracker ('template' engine) correlates every
+        frame with a template made in its first frame, so separately seeded
+        chunks never agree; the video is then tracked in a single pass by
+        track_spot instead. Neither checkpointing nor stats are supported.'''
+
+    if engine == 'template':
+        return track_spot(filename, first_spot, max_pix, spot_size, \
+                          spot_brightness, start_frame, stop_frame, \
+                          file_type, predict, recovered, engine)
+
+    if n_chunks is None:
+        n_chunks = os.cpu_count() or 1
+    n = stop_frame - start_frame + 1
+    chunk_len = max(-(-n // n_chunks), overlap + 1)
+    bounds = list(range(start_frame, stop_frame + 1, chunk_len))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for k, first in enumerate(bounds):
+            last = min(first + chunk_len - 1, stop_frame)
+            if k > 0:
+                first = max(first - overlap, start_frame)
+            futures.append(executor.submit(track_chunk, filename, \
+                           first_spot, max_pix, spot_size, spot_brightness, \
+                           first, last, file_type, k > 0, predict, engine))
+
+        spot_track, found_again = futures[0].result()
+        for k in range(1, len(bounds)):
+            chunk, chunk_found_again = futures[k].result()
+            first = bounds[k]
+            n_over = first - max(first - overlap, start_frame)
+
+            # the previous chunk may have ended early with the video
+            if len(spot_track) < first - start_frame:
+                break
+
+            if n_over > 0 and len(chunk) >= n_over and \
+               chunk[n_over - 1] == spot_track[-1]:
+                spot_track.extend(chunk[n_over:])
+                found_again.extend(j for j in chunk_found_again if j >= first)
             else:
-                centroid = cluster_center(points)
-                j = 2 #resents the counter
-            spot_track.append(centroid)
+                print ('Chunk starting at frame %d does not agree with the'
+                       ' previous chunk, tracking it again' % first)
+                last = min(first + chunk_len - 1, stop_frame)
+                chunk, chunk_found_again = track_chunk(filename, \
+                    spot_track[-1], max_pix, spot_size, spot_brightness, \
+                    first, last, file_type, False, predict, engine)
+                spot_track.extend(chunk)
+                found_again.extend(chunk_found_again)
 
-        i += 1
-        
+    if recovered is not None:
+        recovered.extend(found_again)
+    spot_track.metadata.update(start_frame = start_frame, \
+                               stop_frame = stop_frame)
     return spot_track
 
 if "__main__" == __name__:
@@ -0,0 +1,217 @@
+'''
+Trajectory.py
+
+The Trajectory type: the positions of a tracked bead, frame by frame, as
+returned by PILBeadTracking2.track_spot and used by the analysis.
+
+Trajectory.save writes a trajectory in a binary format that can be reloaded
+instantly, however long it is: a .npy file of one RECORD per frame,
+
+    xy     float64 (2,)  the (x, y) position (pixels)
+    frame  int64         the frame number
+    found  bool          whether the bead was found in the frame
+
+packed little-endian with no padding (25 bytes per frame), and a JSON
+sidecar with the same name ending in .json holding the number of frames and
+the metadata. Trajectory.load memory-maps the .npy file with
+np.load(mmap_mode='r'), so positions are only read from disk when they are
+used.
+'''
+
+import os
+import json
+import numpy as np
+
+RECORD = np.dtype([('xy', '<f8', (2,)), ('frame', '<i8'), ('found', '?')])
+
+def sidecar_path(path):
+    '''Return the path of the JSON sidecar of the .npy file path.'''
+    return os.path.splitext(path)[0] + '.json'
+
+class Trajectory(object):
+    '''The (x, y) positions (pixels) of a bead in a sequence of frames, with
+       the frame number of each position, whether the bead was found in that
+       frame (otherwise the position is carried over from the previous
+       frame) and a dictionary of metadata, such as the tracking parameters.
+
+       The positions are stored in a preallocated (capacity, 2) float array
+       that doubles in size when full, so append() takes amortised constant
+       time. xy, x, y, frames and found are views of the stored arrays, and
+       np.asarray(trajectory) is the (n, 2) array of positions, so no copy
+       is made when they are passed to the analysis. Indexing with an
+       integer returns an [x, y] list, as a list of positions would; slicing
+       returns a new Trajectory.
+    '''
+
+    def __init__(self, capacity=1024, metadata=None):
+        capacity = max(int(capacity), 1)
+        self._xy = np.empty((capacity, 2))
+        self._frames = np.empty(capacity, dtype=np.int64)
+        self._found = np.empty(capacity, dtype=bool)
+        self.n = 0
+        self.metadata = dict(metadata or {})
+
+    @classmethod
+    def from_arrays(cls, xy, frames=None, found=None, metadata=None):
+        '''Return a Trajectory of the (n, 2) positions xy. frames defaults
+           to 0, 1, ..., n - 1 and found to all True.
+        '''
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        n = len(xy)
+        traj = cls(n, metadata)
+        traj._xy[:n] = xy
+        traj._frames[:n] = np.arange(n) if frames is None else frames
+        traj._found[:n] = True if found is None else found
+        traj.n = n
+        return traj
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''Return the Trajectory saved in the .npy file path (and its
+           sidecar, if there is one). With the default mmap_mode the
+           positions are memory-mapped read-only; appending to the
+           Trajectory then copies them into memory.
+        '''
+        records = np.load(path, mmap_mode=mmap_mode)
+        if records.dtype != RECORD:
+            raise ValueError('%s is not a saved trajectory' % path)
+        metadata = {}
+        if os.path.isfile(sidecar_path(path)):
+            with open(sidecar_path(path)) as f:
+                metadata = json.load(f)['metadata']
+        traj = cls(1, metadata)
+        # views of the records, so nothing is read yet
+        traj._xy = records['xy']
+        traj._frames = records['frame']
+        traj._found = records['found']
+        traj.n = len(records)
+        return traj
+
+    def save(self, path):
+        '''Save the trajectory to the .npy file path and its metadata to the
+           JSON sidecar (see the module docstring for the layout).
+        '''
+        records = np.lib.format.open_memmap(path, mode='w+', dtype=RECORD,
+                                            shape=(self.n,))
+        records['xy'] = self.xy
+        records['frame'] = self.frames
+        records['found'] = self.found
+        records.flush()
+        del records
+
+        sidecar = {
+            'format'   : 'Trajectory',
+            'fields'   : [[name, RECORD[name].base.str,
+                           list(RECORD[name].shape)] for name in RECORD.names],
+            'n_frames' : self.n,
+            'metadata' : self.metadata,
+        }
+        with open(sidecar_path(path), 'w') as f:
+            json.dump(sidecar, f, indent=4, separators=(',', ': '))
+
+    def reserve(self, capacity):
+        '''Make room for at least capacity positions.'''
+        if capacity <= len(self._xy) and self._xy.flags.writeable:
+            return
+        capacity = max(capacity, 2*len(self._xy))
+        for name in ('_xy', '_frames', '_found'):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def append(self, position, frame=None, found=True):
+        '''Add the position (x, y) of the bead in frame, by default the frame
+           after the last one.
+        '''
+        if self.n == len(self._xy):
+            self.reserve(self.n + 1)
+        if frame is None:
+            frame = self._frames[self.n - 1] + 1 if self.n else 0
+        self._xy[self.n] = position
+        self._frames[self.n] = frame
+        self._found[self.n] = found
+        self.n += 1
+
+    def extend(self, positions):
+        '''Add the positions of another Trajectory, or a sequence of (x, y)
+           positions in the following frames.
+        '''
+        if not isinstance(positions, Trajectory):
+            xy = np.asarray(positions, dtype=float).reshape(-1, 2)
+            first = self._frames[self.n - 1] + 1 if self.n else 0
+            positions = Trajectory.from_arrays(
+                xy, first + np.arange(len(xy)))
+        n = self.n + len(positions)
+        self.reserve(n)
+        self._xy[self.n:n] = positions.xy
+        self._frames[self.n:n] = positions.frames
+        self._found[self.n:n] = positions.found
+        self.n = n
+
+    @property
+    def xy(self):
+        '''The (n, 2) array of positions.'''
+        return self._xy[:self.n]
+
+    @property
+    def x(self):
+        return self._xy[:self.n, 0]
+
+    @property
+    def y(self):
+        return self._xy[:self.n, 1]
+
+    @property
+    def frames(self):
+        '''The frame number of each position.'''
+        return self._frames[:self.n]
+
+    @property
+    def found(self):
+        '''True for each frame in which the bead was found.'''
+        return self._found[:self.n]
+
+    @property
+    def lost(self):
+        '''The frame numbers in which the bead was not found.'''
+        return self.frames[~self.found]
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Trajectory.from_arrays(self.xy[i], self.frames[i],
+                                          self.found[i], self.metadata)
+        return self.xy[i].tolist()
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self.xy[i].tolist()
+
+    def __array__(self, dtype=None, copy=None):
+        # a view unless a copy is asked for (np.array(trajectory)) or
+        # needed for dtype
+        if dtype is None or np.dtype(dtype) == self._xy.dtype:
+            return self.xy.copy() if copy else self.xy
+        if copy is False:
+            raise ValueError('a copy is needed to convert to %s' % dtype)
+        return self.xy.astype(dtype)
+
+    def tolist(self):
+        return self.xy.tolist()
+
+    def __getstate__(self):
+        # pickle (e.g. between processes) without the unused capacity
+        return {'xy': self.xy.copy(), 'frames': self.frames.copy(),
+                'found': self.found.copy(), 'metadata': self.metadata}
+
+    def __setstate__(self, state):
+        self.__dict__.update(Trajectory.from_arrays(
+            state['xy'], state['frames'], state['found'],
+            state['metadata']).__dict__)
+
+    def __repr__(self):
+        return 'Trajectory(%d frames, %d lost)' % (self.n,
+                                                   self.n - np.sum(self.found))
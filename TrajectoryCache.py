@@ -0,0 +1,217 @@
+'''
+TrajectoryCache.py
+
+An on-disk cache of tracked bead trajectories, so that a video is only
+tracked once for a given set of tracking parameters. Re-running an analysis
+with a different temperature or pixel size then goes straight to
+TrapAnalysis.
+
+Each trajectory is stored in its own .npz file, named by a hash of the
+tracking parameters and of the part of the video that was tracked: its TIFF
+header and the image data of the pages in the tracked frame range, so that
+a copy of a video shares its cached trajectories. Only that range of a long
+video is read to key the cache, as it is to track it. The modification time
+of a file records when it was last used, and the least recently used
+trajectories are deleted once the cache grows beyond its size limit.
+'''
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from PIL import Image
+
+from Trajectory import Trajectory
+
+class TrajectoryCache(object):
+    '''A directory of cached trajectories holding at most max_bytes of
+       them. Content hashes of the videos are remembered, by path, size,
+       modification time and frame range, in hashes.json so that the frames
+       of an unchanged video are only read once. At most max_hashes of them
+       are kept.
+    '''
+
+    max_hashes = 1000
+
+    def __init__(self, directory, max_bytes=500 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def file_hash(self, path, start_frame=0, stop_frame=None, cancel=None,
+                  progress=None):
+        '''Return a SHA-1 hash of the TIFF file path identifying the frames
+           [start_frame, stop_frame] (all frames if stop_frame is None): of
+           the frame range, the file's header and the image data of those
+           pages, which are the only pages read. Return None if the
+           threading.Event cancel is set while hashing. progress, if given,
+           is called with the number of each page once it has been hashed.
+        '''
+        st = os.stat(path)
+        signature = '%s|%d|%d|%d|%s' % (os.path.abspath(path), st.st_size,
+                                        st.st_mtime_ns, max(start_frame, 0),
+                                        stop_frame)
+        memo_path = os.path.join(self.directory, 'hashes.json')
+        try:
+            with open(memo_path) as f:
+                memo = json.load(f)
+        except (IOError, ValueError):
+            memo = {}
+        if signature in memo:
+            return memo[signature]
+
+        h = hashlib.sha1(('%d|%s' % (max(start_frame, 0),
+                                     stop_frame)).encode())
+        with open(path, 'rb') as f:
+            h.update(f.read(8))
+            im = Image.open(f)
+            i = max(start_frame, 0)
+            while stop_frame is None or i <= stop_frame:
+                if cancel is not None and cancel.is_set():
+                    return None
+                try:
+                    im.seek(i)
+                except EOFError:
+                    break
+                h.update(('%d|%s|%s' % (i, im.mode, im.size)).encode())
+                # strips or tiles of the page, as stored
+                tags = im.tag_v2
+                offsets = tags.get(273, tags.get(324))
+                counts = tags.get(279, tags.get(325))
+                if offsets and counts:
+                    for offset, count in zip(offsets, counts):
+                        f.seek(offset)
+                        h.update(f.read(count))
+                else:
+                    h.update(im.tobytes())
+                if progress is not None:
+                    progress(i)
+                i += 1
+        memo[signature] = h.hexdigest()
+        self.replace(memo_path, lambda f: f.write(
+            json.dumps(memo, indent=1).encode()))
+        return memo[signature]
+
+    def key(self, path, settings, cancel=None, progress=None):
+        '''Return the cache key of the trajectory tracked in the video path
+           with the tracking parameters in the dictionary settings, which
+           include its 'start_frame' and 'stop_frame'. Return None if cancel
+           is set before the frames are hashed (see file_hash, to which
+           progress is also passed).
+        '''
+        file_hash = self.file_hash(path, settings.get('start_frame', 0),
+                                   settings.get('stop_frame'), cancel,
+                                   progress)
+        if file_hash is None:
+            return None
+        h = hashlib.sha1(file_hash.encode())
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        '''Return the cached (spot_track, recovered) for key, or None if it
+           is not in the cache. spot_track is a Trajectory, with the metadata
+           it was stored with, and recovered the list of recovered frames, or
+           None if there was none when the trajectory was stored.
+        '''
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                metadata = json.loads(str(data['metadata'])) \
+                           if 'metadata' in data.files else None
+                spot_track = Trajectory.from_arrays(data['spot_track'],
+                                                    data['frames'],
+                                                    data['found'], metadata)
+                recovered = data['recovered'].tolist() \
+                            if data['has_recovered'] else None
+        except (IOError, ValueError, KeyError):
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return spot_track, recovered
+
+    def put(self, key, spot_track, recovered=None):
+        '''Store a trajectory, then evict the least recently used ones if the
+           cache is over its size limit.
+        '''
+        if not isinstance(spot_track, Trajectory):
+            spot_track = Trajectory.from_arrays(spot_track)
+        self.replace(self.path(key), lambda f: np.savez(f,
+            spot_track=spot_track.xy, frames=spot_track.frames,
+            found=spot_track.found,
+            metadata=json.dumps(spot_track.metadata, sort_keys=True),
+            recovered=np.array(recovered or [], dtype=int),
+            has_recovered=recovered is not None))
+        self.evict()
+
+    def evict(self):
+        '''Delete the least recently used trajectories until the cache holds
+           at most max_bytes of them, and prune hashes.json.
+        '''
+        self.prune_hashes()
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def prune_hashes(self):
+        '''Forget the content hashes of videos that have been deleted or
+           changed since they were hashed, and all but the max_hashes most
+           recently hashed of the rest.
+        '''
+        memo_path = os.path.join(self.directory, 'hashes.json')
+        try:
+            with open(memo_path) as f:
+                memo = json.load(f)
+        except (IOError, ValueError):
+            return
+        kept = {}
+        for signature, value in memo.items():
+            path, size, mtime_ns = signature.rsplit('|', 4)[:3]
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns) == (int(size), int(mtime_ns)):
+                kept[signature] = value
+        # hashes are added to the end of the memo
+        kept = dict(list(kept.items())[-self.max_hashes:])
+        if len(kept) < len(memo):
+            self.replace(memo_path, lambda f: f.write(
+                json.dumps(kept, indent=1).encode()))
+
+    def replace(self, path, write):
+        '''Write a file by calling write on a temporary file that then
+           atomically replaces path, so that readers (possibly in other
+           processes) never see it half written.
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
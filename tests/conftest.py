@@ -0,0 +1,43 @@
+'''
+Shared fixtures for the tests. Run them from the repository root with
+
+    python -m pytest
+'''
+
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def bead_frames(n=60, size=64, seed=0):
+    '''Return n 8-bit frames of a Gaussian bead diffusing in a harmonic
+       trap around the centre of a size x size frame.
+    '''
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    x = y = 0.0
+    frames = []
+    for i in range(n):
+        x = 0.8*x + rng.normal(0, 0.6)
+        y = 0.8*y + rng.normal(0, 0.6)
+        r2 = (xx - size/2 - x)**2 + (yy - size/2 - y)**2
+        im = 20 + 200*np.exp(-r2/8.0)
+        frames.append(Image.fromarray(im.astype(np.uint8)))
+    return frames
+
+def save_stack(path, frames, **kwargs):
+    frames[0].save(path, save_all=True, append_images=frames[1:], **kwargs)
+    return str(path)
+
+@pytest.fixture(scope='session')
+def bead_video(tmp_path_factory):
+    '''An uncompressed 60-frame TIFF stack of a trapped bead.'''
+    path = tmp_path_factory.mktemp('video') / 'bead.tif'
+    return save_stack(path, bead_frames())
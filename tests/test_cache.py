@@ -0,0 +1,95 @@
+'''
+TrajectoryCache: hits and misses by video content and tracking parameters,
+least recently used eviction and pruning of the remembered hashes.
+'''
+
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from Trajectory import Trajectory
+from TrajectoryCache import TrajectoryCache
+
+SETTINGS = {'start_frame': 0, 'stop_frame': 29, 'spot_radius': 6}
+
+def trajectory(n=30, seed=0):
+    rng = np.random.default_rng(seed)
+    return Trajectory.from_arrays(rng.normal(32, 1, (n, 2)), \
+                                  metadata={'engine': 'average'})
+
+def test_hit_and_miss(bead_video, tmp_path):
+    cache = TrajectoryCache(str(tmp_path / 'cache'))
+    key = cache.key(bead_video, SETTINGS)
+    assert cache.get(key) is None
+
+    spot_track = trajectory()
+    cache.put(key, spot_track, [3, 7])
+    hit, recovered = cache.get(key)
+    np.testing.assert_array_equal(np.asarray(hit), np.asarray(spot_track))
+    assert hit.metadata == spot_track.metadata
+    assert recovered == [3, 7]
+
+    # other parameters or another frame range miss
+    assert cache.key(bead_video, dict(SETTINGS, spot_radius=5)) != key
+    assert cache.key(bead_video, dict(SETTINGS, stop_frame=30)) != key
+
+def test_key_depends_on_content_only(bead_video, tmp_path):
+    cache = TrajectoryCache(str(tmp_path / 'cache'))
+    key = cache.key(bead_video, SETTINGS)
+
+    copy = str(tmp_path / 'copy.tif')
+    shutil.copy(bead_video, copy)
+    assert cache.key(copy, SETTINGS) == key
+    os.utime(copy, (time.time() + 10, time.time() + 10))
+    assert cache.key(copy, SETTINGS) == key
+
+    # a change to a tracked frame changes the key
+    with open(copy, 'r+b') as f:
+        f.seek(-100, os.SEEK_END)
+        f.write(b'\xff' * 10)
+    assert cache.key(copy, dict(SETTINGS, stop_frame=59)) != \
+           cache.key(bead_video, dict(SETTINGS, stop_frame=59))
+
+def test_cancelled_key(bead_video, tmp_path):
+    cache = TrajectoryCache(str(tmp_path / 'cache'))
+    cancel = threading.Event()
+    cancel.set()
+    assert cache.key(bead_video, SETTINGS, cancel) is None
+
+def test_least_recently_used_eviction(bead_video, tmp_path):
+    cache = TrajectoryCache(str(tmp_path / 'cache'))
+    keys = [cache.key(bead_video, dict(SETTINGS, spot_radius=r)) \
+            for r in range(4)]
+    for k, key in enumerate(keys):
+        cache.put(key, trajectory(seed=k))
+        os.utime(cache.path(key), (1000 + k, 1000 + k))
+    size = os.path.getsize(cache.path(keys[0]))
+
+    # using the oldest entry makes the second oldest the next to go
+    assert cache.get(keys[0]) is not None
+    cache.max_bytes = 3 * size
+    cache.evict()
+    assert cache.get(keys[1]) is None
+    for key in (keys[0], keys[2], keys[3]):
+        assert cache.get(key) is not None
+
+def test_hashes_are_pruned(bead_video, tmp_path):
+    cache = TrajectoryCache(str(tmp_path / 'cache'))
+    copy = str(tmp_path / 'copy.tif')
+    shutil.copy(bead_video, copy)
+    cache.max_hashes = 3
+    for stop in range(10, 15):
+        cache.key(bead_video, dict(SETTINGS, stop_frame=stop))
+    cache.key(copy, SETTINGS)
+    os.remove(copy)
+
+    cache.evict()
+    with open(os.path.join(cache.directory, 'hashes.json')) as f:
+        memo = json.load(f)
+    assert len(memo) == 3
+    assert all(s.startswith(os.path.abspath(bead_video)) for s in memo)
+    assert all(s.endswith(('|12', '|13', '|14')) for s in memo)
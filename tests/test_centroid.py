@@ -0,0 +1,61 @@
+'''
+The vectorized find_points and find_centroid must give the same results as
+the pixel-by-pixel reference select_points and cluster_center.
+'''
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import PILBeadTracking2 as pbt
+
+BOXES = [
+    (10, 12, 30, 40),    # inside the frame
+    (-5, -8, 10, 6),     # off the top left corner
+    (50, 40, 80, 90),    # off the bottom right corner
+    (-10, 20, 100, 30),  # wider than the frame
+    (70, 70, 90, 90),    # entirely outside the frame
+    (20, 20, 20, 30),    # empty
+]
+
+def random_image(mode, seed):
+    rng = np.random.default_rng(seed)
+    shape = (48, 64) if mode == 'L' else (48, 64, 3)
+    return Image.fromarray(rng.integers(0, 256, shape, dtype=np.uint8), mode)
+
+def reference_centroid(imag, threshold, file_type, box, colour=None):
+    points = pbt.select_points(imag, threshold, file_type, box, colour)
+    return pbt.cluster_center(points) if points else None
+
+CASES = [('8-bit', 'L', None, 200)] + \
+        [('RGB', 'RGB', colour, 60) for colour in ('r', 'g', 'b')]
+
+@pytest.mark.parametrize('file_type, mode, colour, threshold', CASES)
+@pytest.mark.parametrize('box', BOXES)
+def test_find_points_matches_select_points(file_type, mode, colour,
+                                           threshold, box):
+    imag = random_image(mode, seed=1)
+    expected = pbt.select_points(imag, threshold, file_type, box, colour)
+    for source in (imag, np.asarray(imag)):
+        points = pbt.find_points(source, threshold, file_type, box, colour)
+        assert [tuple(p) for p in points.tolist()] == \
+               [tuple(p) for p in expected]
+
+@pytest.mark.parametrize('file_type, mode, colour, threshold', CASES)
+@pytest.mark.parametrize('box', BOXES)
+def test_find_centroid_matches_cluster_center(file_type, mode, colour,
+                                              threshold, box):
+    imag = random_image(mode, seed=2)
+    expected = reference_centroid(imag, threshold, file_type, box, colour)
+    for source in (imag, np.asarray(imag)):
+        centroid = pbt.find_centroid(source, threshold, file_type, box, colour)
+        if expected is None:
+            assert centroid is None
+        else:
+            np.testing.assert_allclose(centroid, expected, rtol=0,
+                                       atol=1e-12)
+
+def test_find_centroid_without_points():
+    imag = Image.new('L', (20, 20), 10)
+    assert pbt.find_centroid(imag, 100, '8-bit', (0, 0, 20, 20)) is None
+    assert pbt.select_points(imag, 100, '8-bit', (0, 0, 20, 20)) == []
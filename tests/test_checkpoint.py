@@ -0,0 +1,115 @@
+'''
+An interrupted track resumed from its checkpoint must match a track made in
+one go, and a checkpoint made with other parameters must not be resumed.
+'''
+
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import PILBeadTracking2 as pbt
+
+PARAMS = dict(first_spot=[32, 32], max_pix=5, spot_size=6, \
+              spot_brightness=100, start_frame=0, stop_frame=59, \
+              file_type='8-bit')
+
+class Interrupted(pbt.FrameSource):
+    '''A FrameSource interrupted, as by Ctrl-C, when frame at is read'''
+
+    def __init__(self, filename, at):
+        pbt.FrameSource.__init__(self, filename)
+        self.at = at
+
+    def frame(self, i):
+        if i == self.at:
+            raise KeyboardInterrupt
+        return pbt.FrameSource.frame(self, i)
+
+def interrupt(video, checkpoint, at, **kwargs):
+    with pytest.raises(KeyboardInterrupt):
+        pbt.track_spot(Interrupted(video, at), checkpoint=checkpoint, \
+                       **dict(PARAMS, **kwargs))
+    assert os.path.isfile(checkpoint)
+
+@pytest.mark.parametrize('predict, engine', [(False, 'average'), \
+                                             (True, 'average'), \
+                                             (False, 'template')])
+def test_resume_matches_single_run(bead_video, tmp_path, predict, engine):
+    checkpoint = str(tmp_path / 'track.npz')
+    expected = pbt.track_spot(bead_video, predict=predict, engine=engine, \
+                              **PARAMS)
+    interrupt(bead_video, checkpoint, 25, predict=predict, engine=engine)
+
+    spot_track = pbt.track_spot(bead_video, predict=predict, engine=engine, \
+                                checkpoint=checkpoint, resume=True, **PARAMS)
+    assert len(spot_track) == len(expected) == 60
+    np.testing.assert_array_equal(np.asarray(spot_track), \
+                                  np.asarray(expected))
+    np.testing.assert_array_equal(spot_track.frames, expected.frames)
+    assert spot_track.metadata == expected.metadata
+    # a completed track leaves no checkpoint behind
+    assert not os.path.isfile(checkpoint)
+
+def test_checkpoint_contents(bead_video, tmp_path):
+    checkpoint = str(tmp_path / 'track.npz')
+    interrupt(bead_video, checkpoint, 25)
+    tracker = pbt.make_tracker(PARAMS['first_spot'], 5, 6, 100, '8-bit', \
+                               False, 'average')
+    spot_track, last, recovered = pbt.load_checkpoint(checkpoint, tracker)
+    assert last == 24
+    assert len(spot_track) == 25
+    assert spot_track.frames.tolist() == list(range(25))
+    assert spot_track.metadata['stop_frame'] == PARAMS['stop_frame']
+
+def test_other_parameters_are_not_resumed(bead_video, tmp_path):
+    checkpoint = str(tmp_path / 'track.npz')
+    interrupt(bead_video, checkpoint, 25)
+
+    tracker = pbt.make_tracker(PARAMS['first_spot'], 5, 6, 100, '8-bit', \
+                               False, 'average')
+    metadata = pbt.load_checkpoint(checkpoint, tracker)[0].metadata
+    with pytest.raises(ValueError):
+        pbt.load_checkpoint(checkpoint, tracker, \
+                            dict(metadata, spot_brightness=120))
+
+    # tracking starts again from start_frame with the new parameters
+    params = dict(PARAMS, spot_brightness=120)
+    expected = pbt.track_spot(bead_video, **params)
+    spot_track = pbt.track_spot(bead_video, checkpoint=checkpoint, \
+                                resume=True, **params)
+    np.testing.assert_array_equal(np.asarray(spot_track), \
+                                  np.asarray(expected))
+    assert spot_track.metadata['spot_brightness'] == 120
+
+def test_template_checkpoint_before_template(bead_video, tmp_path):
+    # the spot is never bright enough, so no template is ever made
+    checkpoint = str(tmp_path / 'track.npz')
+    cancel = threading.Event()
+    cancel.set()
+    params = dict(PARAMS, spot_brightness=250, engine='template')
+    spot_track = pbt.track_spot(bead_video, checkpoint=checkpoint, \
+                                cancel=cancel, **params)
+    assert len(spot_track) == 1
+    assert os.path.isfile(checkpoint)
+
+    tracker = pbt.make_tracker(PARAMS['first_spot'], 5, 6, 250, '8-bit', \
+                               False, 'template')
+    spot_track, last, recovered = pbt.load_checkpoint(checkpoint, tracker)
+    assert last == 0
+    assert tracker.template_fft is None
+
+    expected = pbt.track_spot(bead_video, **params)
+    spot_track = pbt.track_spot(bead_video, checkpoint=checkpoint, \
+                                resume=True, **params)
+    np.testing.assert_array_equal(np.asarray(spot_track), \
+                                  np.asarray(expected))
+
+def test_other_tracker_is_not_resumed(bead_video, tmp_path):
+    checkpoint = str(tmp_path / 'track.npz')
+    interrupt(bead_video, checkpoint, 25)
+    tracker = pbt.make_tracker(PARAMS['first_spot'], 5, 6, 100, '8-bit', \
+                               False, 'template')
+    with pytest.raises(ValueError):
+        pbt.load_checkpoint(checkpoint, tracker)
@@ -0,0 +1,80 @@
+'''
+label_regions labels the 4-connected regions of a mask, and detect_beads
+finds the beads in a frame from them.
+'''
+
+import numpy as np
+from PIL import Image
+
+import PILBeadTracking2 as pbt
+
+def reference_labels(mask):
+    '''labels the 4-connected regions of mask by flood fill, numbered in
+       order of their first pixel in row-major order'''
+    labels = np.zeros(mask.shape, dtype=int)
+    n = 0
+    for start in zip(*np.nonzero(mask)):
+        if labels[start]:
+            continue
+        n += 1
+        stack = [start]
+        labels[start] = n
+        while stack:
+            y, x = stack.pop()
+            for p in ((y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1)):
+                if 0 <= p[0] < mask.shape[0] and 0 <= p[1] < mask.shape[1] \
+                   and mask[p] and not labels[p]:
+                    labels[p] = n
+                    stack.append(p)
+    return labels, n
+
+def two_beads(size=(80, 60)):
+    w, h = size
+    yy, xx = np.mgrid[:h, :w]
+    im = 10.0 + np.zeros((h, w))
+    for (x, y, peak) in ((20.3, 15.6, 150), (55.8, 40.2, 230)):
+        im += peak*np.exp(-((xx - x)**2 + (yy - y)**2)/(2*2.0**2))
+    # a speck of two pixels, too small to be a bead
+    im[50, 5:7] = 250
+    return Image.fromarray(im.astype(np.uint8))
+
+def test_label_regions_matches_flood_fill():
+    rng = np.random.default_rng(0)
+    for density in (0.3, 0.55, 0.7):
+        mask = rng.random((40, 50)) < density
+        labels, n = pbt.label_regions(mask)
+        expected, n_expected = reference_labels(mask)
+        assert n == n_expected
+        np.testing.assert_array_equal(labels, expected)
+
+def test_label_regions_shapes():
+    # a spiral needs many propagation steps; diagonal neighbours are not
+    # connected
+    mask = np.array([[1, 1, 1, 1, 1, 0, 1],
+                     [0, 0, 0, 0, 1, 0, 0],
+                     [1, 1, 1, 0, 1, 0, 1],
+                     [1, 0, 0, 0, 1, 1, 0],
+                     [1, 1, 1, 1, 1, 0, 0]], dtype=bool)
+    labels, n = pbt.label_regions(mask)
+    assert n == 3
+    assert len(set(labels[mask].tolist())) == 3
+    assert labels[0, 0] == labels[2, 0] == labels[4, 4] == labels[3, 5]
+    assert len(set([labels[0, 0], labels[0, 6], labels[2, 6]])) == 3
+
+    empty, n = pbt.label_regions(np.zeros((5, 5), dtype=bool))
+    assert n == 0 and not empty.any()
+
+def test_detect_beads():
+    frame = two_beads()
+    beads = pbt.detect_beads(frame, 60, '8-bit', 5)
+    # brightest first, the speck rejected by its area
+    assert len(beads) == 2
+    np.testing.assert_allclose(beads[0], (55.8, 40.2), atol=0.3)
+    np.testing.assert_allclose(beads[1], (20.3, 15.6), atol=0.3)
+    # the same from the frame as an array
+    np.testing.assert_allclose(pbt.detect_beads(np.asarray(frame), 60, \
+                                                '8-bit', 5), beads)
+
+def test_detect_no_beads():
+    frame = Image.new('L', (30, 20), 10)
+    assert pbt.detect_beads(frame, 60, '8-bit', 5) == []
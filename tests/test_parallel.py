@@ -0,0 +1,37 @@
+'''
+track_spot_parallel must stitch its chunks into the same trajectory as a
+single pass of track_spot.
+'''
+
+import numpy as np
+import pytest
+
+import PILBeadTracking2 as pbt
+
+ARGS = ([32, 32], 5, 6, 100)
+
+@pytest.mark.parametrize('engine', ['average', 'template'])
+@pytest.mark.parametrize('n_chunks', [2, 4])
+def test_parallel_matches_single_pass(bead_video, engine, n_chunks):
+    expected = pbt.track_spot(bead_video, *ARGS, 0, 59, '8-bit', \
+                              engine=engine)
+    recovered = []
+    spot_track = pbt.track_spot_parallel(bead_video, *ARGS, 0, 59, '8-bit', \
+                                         recovered=recovered, engine=engine, \
+                                         n_chunks=n_chunks, overlap=5, \
+                                         max_workers=2)
+    assert len(spot_track) == len(expected) == 60
+    np.testing.assert_array_equal(np.asarray(spot_track), \
+                                  np.asarray(expected))
+    np.testing.assert_array_equal(spot_track.frames, expected.frames)
+    assert spot_track.metadata == expected.metadata
+    assert recovered == []
+
+def test_parallel_past_the_end(bead_video):
+    expected = pbt.track_spot(bead_video, *ARGS, 10, 200, '8-bit')
+    spot_track = pbt.track_spot_parallel(bead_video, *ARGS, 10, 200, \
+                                         '8-bit', n_chunks=4, overlap=5, \
+                                         max_workers=2)
+    assert len(spot_track) == len(expected) == 50
+    np.testing.assert_array_equal(np.asarray(spot_track), \
+                                  np.asarray(expected))
@@ -0,0 +1,69 @@
+'''
+PredictiveTracker finds a bead again after it has been lost, and records
+the frame in which it was recovered.
+'''
+
+import numpy as np
+from PIL import Image
+
+import PILBeadTracking2 as pbt
+from conftest import save_stack
+
+def jumping_bead(path, n=30, lost=(12, 15), jump=(25, -18)):
+    '''a bead drifting 0.5 px per frame in x that disappears in the frames
+       [lost[0], lost[1]) and reappears displaced by jump'''
+    yy, xx = np.mgrid[:80, :100]
+    frames = []
+    for i in range(n):
+        x, y = 20 + 0.5*i, 50.0
+        if i >= lost[1]:
+            x, y = x + jump[0], y + jump[1]
+        im = np.full((80, 100), 20.0)
+        if not lost[0] <= i < lost[1]:
+            im += 200*np.exp(-((xx - x)**2 + (yy - y)**2)/8.0)
+        frames.append(Image.fromarray(im.astype(np.uint8)))
+    return save_stack(path, frames)
+
+def test_recovers_lost_bead(tmp_path):
+    video = jumping_bead(tmp_path / 'jump.tif')
+    recovered = []
+    spot_track = pbt.track_spot(video, [20, 50], 5, 6, 100, 0, 29, \
+                                '8-bit', predict=True, recovered=recovered)
+    assert recovered == [15]
+    assert spot_track.found.tolist() == \
+           [not 12 <= i < 15 for i in range(30)]
+    # the bead is followed after it reappears
+    np.testing.assert_allclose(spot_track[29], (20 + 14.5 + 25, 32), \
+                               atol=0.5)
+
+    # the basic tracker loses it for good
+    plain = pbt.track_spot(video, [20, 50], 5, 6, 100, 0, 29, '8-bit')
+    assert not plain.found[15:].any()
+
+def test_tracker_state_after_recovery():
+    tracker = pbt.PredictiveTracker([20, 50], 5, 6, 100, '8-bit')
+    yy, xx = np.mgrid[:80, :100]
+    blank = np.full((80, 100), 20, dtype=np.uint8)
+
+    def bead(x, y):
+        im = 20 + 200*np.exp(-((xx - x)**2 + (yy - y)**2)/8.0)
+        return im.astype(np.uint8)
+
+    assert tracker.update(bead(20, 50))
+    assert not tracker.recovered
+
+    # after a miss the search box is doubled, to 22 px either side
+    assert not tracker.update(blank)
+    assert tracker.lost == 1
+    assert tracker.update(bead(38, 64))
+    assert tracker.recovered and tracker.lost == 0
+    np.testing.assert_allclose(tracker.centroid, (38, 64), atol=0.5)
+
+    # after coarse_after misses the whole frame is searched
+    for k in range(tracker.coarse_after):
+        assert not tracker.update(blank)
+    assert tracker.update(bead(85, 10))
+    assert tracker.recovered
+    np.testing.assert_allclose(tracker.centroid, (85, 10), atol=0.5)
+    assert tracker.update(bead(85, 11))
+    assert not tracker.recovered
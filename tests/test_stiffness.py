@@ -0,0 +1,42 @@
+'''
+RunningStiffness accumulates the same equipartition stiffness as
+TrapAnalysis.stiffness.
+'''
+
+import numpy as np
+
+import TrapAnalysis as ta
+
+PARAMS = (296.15, 1/14.5, 1.0, 0.3/14.5**2)
+
+def positions(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    x = 120 + np.cumsum(rng.normal(0, 0.1, n))*0.05 + rng.normal(0, 1.5, n)
+    y = 80 + rng.normal(0, 1.2, n)
+    return x, y
+
+def test_running_stiffness_equals_stiffness():
+    x, y = positions()
+    stats = ta.RunningStiffness(*PARAMS)
+    for k in range(len(x)):
+        stats.add(x[k], y[k])
+        if k + 1 in (2, 10, 1000, len(x)):
+            expected = ta.stiffness(x[:k + 1], y[:k + 1], *PARAMS)
+            np.testing.assert_allclose(stats.stiffness(), expected, \
+                                       rtol=1e-9)
+
+def test_too_few_positions():
+    stats = ta.RunningStiffness(*PARAMS)
+    assert np.all(np.isnan(stats.stiffness()))
+    stats.add(1.0, 2.0)
+    assert np.all(np.isnan(stats.stiffness()))
+
+def test_convergence():
+    x, y = positions()
+    stats = ta.RunningStiffness(*PARAMS, tol=0.05, min_frames=100)
+    for k in range(len(x)):
+        if stats.add(x[k], y[k]):
+            break
+    assert 100 <= stats.n < len(x)
+    assert stats.relative_error() < 0.05
+    assert not ta.RunningStiffness(*PARAMS).converged()
@@ -0,0 +1,57 @@
+'''
+Trajectory.save writes a packed .npy with a JSON sidecar, and
+Trajectory.load memory-maps it back.
+'''
+
+import json
+
+import numpy as np
+import pytest
+
+from Trajectory import Trajectory, sidecar_path
+
+def make_trajectory():
+    rng = np.random.default_rng(0)
+    traj = Trajectory(4, {'engine': 'average', 'first_spot': [32.0, 31.5]})
+    for i in range(10):
+        traj.append(rng.normal(32, 1, 2), 100 + i, i % 4 != 3)
+    return traj
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'trajectory.npy')
+    traj = make_trajectory()
+    traj.save(path)
+
+    loaded = Trajectory.load(path)
+    assert isinstance(loaded.xy, np.memmap)
+    assert len(loaded) == len(traj) == 10
+    np.testing.assert_array_equal(loaded.xy, traj.xy)
+    np.testing.assert_array_equal(loaded.frames, traj.frames)
+    np.testing.assert_array_equal(loaded.found, traj.found)
+    assert loaded.metadata == traj.metadata
+    np.testing.assert_array_equal(np.asarray(loaded), traj.xy)
+
+    with open(sidecar_path(path)) as f:
+        sidecar = json.load(f)
+    assert sidecar['n_frames'] == 10
+    assert [field[0] for field in sidecar['fields']] == \
+           ['xy', 'frame', 'found']
+
+def test_loaded_trajectory_is_read_only(tmp_path):
+    path = str(tmp_path / 'trajectory.npy')
+    make_trajectory().save(path)
+
+    loaded = Trajectory.load(path)
+    with pytest.raises(ValueError):
+        loaded.xy[0] = (0, 0)
+    # appending copies the positions into memory, leaving the file as it was
+    loaded.append((1.0, 2.0), 110, True)
+    assert len(loaded) == 11
+    assert not isinstance(loaded.xy, np.memmap)
+    assert len(Trajectory.load(path)) == 10
+
+def test_load_rejects_other_arrays(tmp_path):
+    path = str(tmp_path / 'positions.npy')
+    np.save(path, np.zeros((10, 2)))
+    with pytest.raises(ValueError):
+        Trajectory.load(path)
@@ -0,0 +1,80 @@
+'''
+WatchFrameSource follows the chain of TIFF directories of a stack itself:
+it must read the same frames as PIL, and only the pages already written
+while the stack is still growing.
+'''
+
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import TiffImagePlugin
+
+import PILBeadTracking2 as pbt
+from conftest import bead_frames, save_stack
+
+FRAMES = bead_frames(n=12)
+
+def watch_all(path, **kwargs):
+    source = pbt.WatchFrameSource(path, poll=0.01, timeout=0.2, **kwargs)
+    return [np.array(frame) for i, frame in source.frames(0, 10**6)]
+
+@pytest.mark.parametrize('compression', [None, 'tiff_deflate', 'packbits'])
+@pytest.mark.parametrize('memmap', [True, False])
+def test_reads_every_page(tmp_path, compression, memmap):
+    kwargs = {'compression': compression} if compression else {}
+    path = save_stack(tmp_path / 'stack.tif', FRAMES, **kwargs)
+    frames = watch_all(path, memmap=memmap)
+    assert len(frames) == len(FRAMES)
+    for frame, expected in zip(frames, FRAMES):
+        np.testing.assert_array_equal(frame, np.asarray(expected))
+
+def test_uncompressed_pages_are_memory_mapped(tmp_path):
+    path = save_stack(tmp_path / 'stack.tif', FRAMES)
+    source = pbt.WatchFrameSource(path, poll=0.01, timeout=0.2)
+    assert isinstance(source.wait_frame(3), np.memmap)
+    assert source.scan() == len(source.ifds) == len(FRAMES)
+
+def test_partly_written_stack(tmp_path):
+    path = save_stack(tmp_path / 'stack.tif', FRAMES)
+    with open(path, 'rb') as f:
+        data = f.read()
+    for cut in (len(data)//3, len(data)//2, len(data) - 10):
+        partial = str(tmp_path / ('partial%d.tif' % cut))
+        with open(partial, 'wb') as f:
+            f.write(data[:cut])
+        frames = watch_all(partial)
+        # only whole pages are read, in order
+        assert 0 < len(frames) < len(FRAMES)
+        for frame, expected in zip(frames, FRAMES):
+            np.testing.assert_array_equal(frame, np.asarray(expected))
+
+def test_growing_stack(tmp_path):
+    path = str(tmp_path / 'live.tif')
+
+    def record():
+        with open(path, 'w+b') as f, \
+             TiffImagePlugin.AppendingTiffWriter(f) as tf:
+            for frame in FRAMES:
+                frame.save(tf, format='TIFF')
+                tf.newFrame()
+                f.flush()
+                time.sleep(0.02)
+
+    camera = threading.Thread(target=record)
+    camera.start()
+    try:
+        source = pbt.WatchFrameSource(path, poll=0.005, timeout=1.0)
+        frames = [np.array(frame) for i, frame in source.frames(0, 10**6)]
+    finally:
+        camera.join()
+    assert len(frames) == len(FRAMES)
+    for frame, expected in zip(frames, FRAMES):
+        np.testing.assert_array_equal(frame, np.asarray(expected))
+
+def test_not_a_tiff(tmp_path):
+    path = tmp_path / 'video.tif'
+    path.write_bytes(b'GIF89a' + bytes(100))
+    with pytest.raises(ValueError):
+        pbt.WatchFrameSource(str(path), timeout=0.1).scan()